@@ -0,0 +1,357 @@
+"""benchmark formatting a synthetic corpus of projects
+
+usage:
+    python benchmarks/bench.py generate DEST [--projects N]
+    python benchmarks/bench.py run [--projects N] [--repeat N] [--json]
+    python benchmarks/bench.py compare REV [REV] [--projects N]
+
+`compare` checks out each git revision (default for the second: the working
+tree) and reports the change in throughput between them.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import functools
+import json
+import os.path
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from collections.abc import Generator
+from collections.abc import Sequence
+from typing import Any
+
+from identify.vendor import licenses
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+CLASSIFIERS = (
+    'Development Status :: 5 - Production/Stable',
+    'Environment :: Console',
+    'Framework :: Django',
+    'Framework :: Pytest',
+    'Intended Audience :: Developers',
+    'Natural Language :: English',
+    'Operating System :: OS Independent',
+    'Operating System :: POSIX :: Linux',
+    'Topic :: Software Development :: Libraries',
+    'Topic :: Utilities',
+    'Typing :: Typed',
+    *(f'Programming Language :: Python :: 3.{i}' for i in range(6, 14)),
+)
+OPS = ('==', '>=', '<', '!=', '~=', '<=')
+READMES = ('README.md', 'README.rst', 'readme.txt', 'README')
+
+
+def _requirement(rand: random.Random) -> str:
+    name = f'lib{rand.randrange(1000)}_{rand.choice("abcdef")}'
+    if rand.random() < .2:
+        name += '[extra]'
+    specs = ', '.join(
+        f'{rand.choice(OPS)} {rand.randrange(10)}.{rand.randrange(10)}'
+        for _ in range(rand.randrange(3))
+    )
+    req = f'{name} {specs}'
+    if rand.random() < .2:
+        req += '; python_version < "3.12"'
+    return req
+
+
+def _license(rand: random.Random) -> str:
+    _, text = rand.choice(licenses.LICENSES)
+    text = text.replace('[year]', '2020').replace('[fullname]', 'Someone')
+    if rand.random() < .3:  # perturbed: a few edited words
+        words = text.split(' ')
+        for _ in range(3):
+            words[rand.randrange(len(words))] = 'perturbed'
+        text = ' '.join(words)
+    return text
+
+
+def _envlist(rand: random.Random) -> str:
+    versions = ','.join(str(v) for v in range(rand.randrange(8, 11), 14))
+    if rand.random() < .5:
+        return f'py3{{{versions}}}-django{{42,50}},pypy3,pre-commit'
+    else:
+        return ','.join(f'py3{v}' for v in versions.split(','))
+
+
+def _setup_cfg(i: int, rand: random.Random) -> str:
+    classifiers = rand.sample(CLASSIFIERS, rand.randrange(len(CLASSIFIERS)))
+    install_requires = [_requirement(rand) for _ in range(rand.randrange(50))]
+    extras = {
+        f'extra{j}': [_requirement(rand) for _ in range(rand.randrange(20))]
+        for j in range(rand.randrange(10))
+    }
+
+    lines = [
+        '[metadata]',
+        f'version = {i}.0',
+        f'name = project-{i}',
+        'classifiers =',
+        *(f'    {classifier}' for classifier in classifiers),
+        '',
+        '[options]',
+        'install_requires =',
+        *(f'    {req}' for req in install_requires),
+        '',
+        '[options.extras_require]',
+    ]
+    for extra, reqs in extras.items():
+        lines.append(f'{extra} =')
+        lines.extend(f'    {req}' for req in reqs)
+    return '\n'.join(lines) + '\n'
+
+
+def generate(dest: str, projects: int, *, seed: int = 0) -> list[str]:
+    """Create `projects` synthetic projects in `dest`, returns setup.cfgs."""
+    rand = random.Random(seed)
+
+    filenames = []
+    for i in range(projects):
+        project = os.path.join(dest, f'project{i}')
+        os.makedirs(project)
+
+        def _write(name: str, contents: str) -> None:
+            with open(os.path.join(project, name), 'w') as f:
+                f.write(contents)
+
+        _write(rand.choice(READMES), 'hello world\n')
+        if rand.random() < .9:
+            _write(rand.choice(('LICENSE', 'LICENSE.txt')), _license(rand))
+        if rand.random() < .8:
+            _write('tox.ini', f'[tox]\nenvlist = {_envlist(rand)}\n')
+        _write('setup.cfg', _setup_cfg(i, rand))
+        filenames.append(os.path.join(project, 'setup.cfg'))
+
+    return filenames
+
+
+@contextlib.contextmanager
+def _corpus(projects: int) -> Generator[tuple[str, list[str]]]:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pristine = os.path.join(tmpdir, 'pristine')
+        yield pristine, generate(pristine, projects)
+
+
+def _fresh_copy(pristine: str, filenames: list[str]) -> list[str]:
+    work = os.path.join(os.path.dirname(pristine), 'work')
+    shutil.rmtree(work, ignore_errors=True)
+    shutil.copytree(pristine, work)
+    return [
+        os.path.join(work, os.path.relpath(filename, pristine))
+        for filename in filenames
+    ]
+
+
+def _run_format_file(pristine: str, filenames: list[str]) -> float:
+    import setup_cfg_fmt
+
+    filenames = _fresh_copy(pristine, filenames)
+    t0 = time.perf_counter()
+    for filename in filenames:
+        setup_cfg_fmt.format_file(
+            filename,
+            include_version_classifiers=False,
+            min_py_version=None,
+            max_py_version=(3, 13),
+        )
+    return time.perf_counter() - t0
+
+
+def _phases(filenames: list[str]) -> dict[str, list[float]]:
+    """Time the individual steps of formatting (on the current tree)."""
+    import setup_cfg_fmt
+
+    def _timed(func: Callable[[], object]) -> float:
+        t0 = time.perf_counter()
+        func()
+        return time.perf_counter() - t0
+
+    ret: dict[str, list[float]] = {
+        'project': [], 'tox': [], 'license': [], 'total': [],
+    }
+    for filename in filenames:
+        with open(filename) as f:
+            contents = f.read()
+
+        ret['project'].append(
+            _timed(functools.partial(setup_cfg_fmt.Project, filename)),
+        )
+        project = setup_cfg_fmt.Project(filename)
+        ret['tox'].append(_timed(lambda: project.tox_envs))
+        license_filename = project.license
+        if license_filename is not None:
+            ret['license'].append(
+                _timed(
+                    functools.partial(
+                        setup_cfg_fmt._license_id,
+                        license_filename,
+                        project.fs,
+                        license_db=None,
+                    ),
+                ),
+            )
+        ret['total'].append(
+            _timed(
+                functools.partial(
+                    setup_cfg_fmt.format_string,
+                    contents,
+                    context=setup_cfg_fmt.Project(filename),
+                    include_version_classifiers=False,
+                    min_py_version=None,
+                    max_py_version=(3, 13),
+                    license_db=None,
+                ),
+            ),
+        )
+    return ret
+
+
+def _ms(s: float) -> str:
+    return f'{s * 1000:.3f}ms'
+
+
+def run(projects: int, repeat: int, *, phases: bool) -> dict[str, Any]:
+    with _corpus(projects) as (pristine, filenames):
+        best = min(
+            _run_format_file(pristine, filenames) for _ in range(repeat)
+        )
+        result: dict[str, Any] = {
+            'module': sys.modules['setup_cfg_fmt'].__file__,
+            'projects': projects,
+            'seconds': best,
+            'files_per_second': projects / best,
+        }
+        if phases:
+            result['phases'] = {
+                name: {
+                    'median': statistics.median(times),
+                    'max': max(times),
+                }
+                for name, times in _phases(filenames).items()
+                if times
+            }
+    return result
+
+
+def _print_run(result: dict[str, Any]) -> None:
+    print(
+        f'{result["projects"]} projects: {_ms(result["seconds"])} '
+        f'({result["files_per_second"]:.1f} files / s)',
+    )
+    for name, stats in result.get('phases', {}).items():
+        print(
+            f'    {name:<8} median: {_ms(stats["median"])} '
+            f'max: {_ms(stats["max"])}',
+        )
+
+
+def _run_at(rev: str | None, projects: int, repeat: int) -> dict[str, Any]:
+    cmd = (
+        sys.executable, os.path.abspath(__file__), 'run', '--json',
+        f'--projects={projects}', f'--repeat={repeat}', '--no-phases',
+    )
+    if rev is None:
+        env = {**os.environ, 'PYTHONPATH': ROOT}
+        out = subprocess.check_output(cmd, env=env)
+        return json.loads(out)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        worktree = os.path.join(tmpdir, 'worktree')
+        subprocess.check_call(
+            (
+                'git', '-C', ROOT, 'worktree', 'add', '--quiet', '--detach',
+                worktree, rev,
+            ),
+        )
+        try:
+            env = {**os.environ, 'PYTHONPATH': worktree}
+            out = subprocess.check_output(cmd, env=env, cwd=worktree)
+        finally:
+            subprocess.check_call(
+                (
+                    'git', '-C', ROOT, 'worktree', 'remove', '--force',
+                    worktree,
+                ),
+            )
+    return json.loads(out)
+
+
+def compare(
+        rev_a: str,
+        rev_b: str | None,
+        projects: int,
+        repeat: int,
+        *,
+        threshold: float,
+) -> int:
+    a = _run_at(rev_a, projects, repeat)
+    b = _run_at(rev_b, projects, repeat)
+
+    print(f'{rev_a}: {_ms(a["seconds"])}')
+    print(f'{rev_b or "working tree"}: {_ms(b["seconds"])}')
+    change = b['seconds'] / a['seconds'] - 1
+    print(f'change: {change:+.1%}')
+
+    if change > threshold:
+        print(f'regression: slower by more than {threshold:.0%}')
+        return 1
+    else:
+        return 0
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate')
+    generate_parser.add_argument('dest')
+    generate_parser.add_argument('--projects', type=int, default=100)
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--projects', type=int, default=100)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--json', action='store_true')
+    run_parser.add_argument(
+        '--no-phases', dest='phases', action='store_false',
+    )
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('rev_a')
+    compare_parser.add_argument('rev_b', nargs='?')
+    compare_parser.add_argument('--projects', type=int, default=100)
+    compare_parser.add_argument('--repeat', type=int, default=3)
+    compare_parser.add_argument(
+        '--threshold', type=float, default=.1,
+        help='fail when slower by more than this ratio (default: %(default)s)',
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generate(args.dest, args.projects, seed=args.seed)
+    elif args.command == 'run':
+        result = run(args.projects, args.repeat, phases=args.phases)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            _print_run(result)
+    else:
+        return compare(
+            args.rev_a, args.rev_b, args.projects, args.repeat,
+            threshold=args.threshold,
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
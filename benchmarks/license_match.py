@@ -0,0 +1,110 @@
+"""compare license identification against `identify.license_id`
+
+usage: python benchmarks/license_match.py [--repeat N]
+
+`cold` is the cost of the first license in a process, including building
+the indices, which is what formatting a single project pays.
+"""
+from __future__ import annotations
+
+import argparse
+import os.path
+import random
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from collections.abc import Sequence
+
+from identify import identify
+from identify.vendor import licenses
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import setup_cfg_fmt  # noqa: E402
+
+
+def _perturb(text: str, rand: random.Random) -> str:
+    lines = text.splitlines()
+    # a filled-in copyright line and a few edited words
+    lines.insert(0, 'Copyright (c) 2019 Some Person')
+    words = '\n'.join(lines).split(' ')
+    for _ in range(3):
+        words[rand.randrange(len(words))] = 'perturbed'
+    return ' '.join(words)
+
+
+def _clear_caches() -> None:
+    setup_cfg_fmt._normed_licenses.cache_clear()
+    setup_cfg_fmt._exact_license_ids.cache_clear()
+    setup_cfg_fmt._license_shingles.cache_clear()
+
+
+def _time(func: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    rand = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = []
+        for spdx, text in licenses.LICENSES:
+            filename = os.path.join(tmpdir, spdx)
+            with open(filename, 'w', encoding='UTF-8') as f:
+                f.write(_perturb(text, rand))
+            filenames.append(filename)
+
+        def identify_all() -> None:
+            for filename in filenames:
+                identify.license_id(filename)
+
+        def _fuzzy(filename: str) -> str | None:
+            with open(filename, encoding='UTF-8') as f:
+                norm = setup_cfg_fmt._norm_license(f.read())
+            return setup_cfg_fmt._fuzzy_license_id(norm)
+
+        def setup_cfg_fmt_all() -> None:
+            for filename in filenames:
+                _fuzzy(filename)
+
+        mismatches = [
+            filename for filename in filenames
+            if identify.license_id(filename) != _fuzzy(filename)
+        ]
+
+        def setup_cfg_fmt_cold() -> None:
+            for filename in filenames:
+                _clear_caches()
+                _fuzzy(filename)
+
+        identify_s = _time(identify_all, args.repeat)
+        cold_s = _time(setup_cfg_fmt_cold, args.repeat)
+        warm_s = _time(setup_cfg_fmt_all, args.repeat)
+
+    n = len(filenames)
+
+    def _ms(s: float) -> str:
+        return f'{s / n * 1000:.2f}ms / license'
+
+    print(f'perturbed licenses: {n} ({len(mismatches)} mismatched)')
+    print(f'identify.license_id:      {_ms(identify_s)}')
+    print(f'_fuzzy_license_id (cold): {_ms(cold_s)}')
+    print(f'_fuzzy_license_id (warm): {_ms(warm_s)}')
+    print(
+        f'speedup: {identify_s / cold_s:.1f}x cold, '
+        f'{identify_s / warm_s:.1f}x warm',
+    )
+    return int(bool(mismatches))
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,121 @@
+"""check that requirement parsing is linear in the size of the input
+
+usage: python benchmarks/requirements.py [--min-size N] [--max-size N]
+
+each worst case is parsed at doubling sizes, the time per character should
+stay flat.  exits nonzero when it grows by more than --threshold.
+"""
+from __future__ import annotations
+
+import argparse
+import os.path
+import sys
+import time
+from collections.abc import Callable
+from collections.abc import Sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import setup_cfg_fmt  # noqa: E402
+
+
+def _long_name(n: int) -> str:
+    return 'a_' * (n // 2)
+
+
+def _many_specifiers(n: int) -> str:
+    return 'pkg>=0' + ', >=1.0, <2' * (n // 11)
+
+
+def _long_version(n: int) -> str:
+    return 'pkg==' + '1.' * (n // 2) + '0'
+
+
+def _many_extras(n: int) -> str:
+    return 'pkg[' + ','.join(f'e_{i}' for i in range(n // 6)) + ']>=1'
+
+
+def _long_marker(n: int) -> str:
+    return 'pkg>=1; ' + ' or '.join(['os_name == "nt"'] * (n // 19))
+
+
+def _long_url(n: int) -> str:
+    return 'pkg @ https://example.com/' + 'a,@' * (n // 3)
+
+
+def _invalid_at_end(n: int) -> str:
+    return 'pkg' + ' ' * n + '~1'
+
+
+def _extras_require(n: int) -> str:
+    lines = ['[metadata]', 'name = pkg', '', '[options.extras_require]']
+    for i in range(n // 500):
+        lines.append(f'extra{i} =')
+        lines.extend(f'    lib{j}_{i} >= {j}, < {j + 1}' for j in range(20))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_extras_require(s: str) -> None:
+    setup_cfg_fmt.format_string(
+        s,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+    )
+
+
+CASES: tuple[tuple[Callable[[int], str], Callable[[str], object]], ...] = (
+    (_long_name, setup_cfg_fmt._parse_requirement),
+    (_many_specifiers, setup_cfg_fmt._parse_requirement),
+    (_long_version, setup_cfg_fmt._parse_requirement),
+    (_many_extras, setup_cfg_fmt._parse_requirement),
+    (_long_marker, setup_cfg_fmt._parse_requirement),
+    (_long_url, setup_cfg_fmt._parse_requirement),
+    (_invalid_at_end, setup_cfg_fmt._parse_requirement),
+    (_extras_require, _format_extras_require),
+)
+
+
+def _time(func: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min-size', type=int, default=10_000)
+    parser.add_argument('--max-size', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--threshold', type=float, default=3,
+        help='fail when the time per character grows by more than this',
+    )
+    args = parser.parse_args(argv)
+
+    retv = 0
+    for make, parse in CASES:
+        per_char = []
+        size = args.min_size
+        while size <= args.max_size:
+            s = make(size)
+            seconds = _time(lambda: parse(s), args.repeat)
+            per_char.append(seconds / len(s))
+            size *= 2
+
+        growth = per_char[-1] / per_char[0]
+        print(
+            f'{make.__name__.lstrip("_"):<16} '
+            f'{per_char[0] * 1e9:6.1f}ns / char -> '
+            f'{per_char[-1] * 1e9:6.1f}ns / char ({growth:.2f}x)',
+        )
+        if growth > args.threshold:
+            print(f'    not linear: grew by more than {args.threshold}x')
+            retv = 1
+    return retv
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
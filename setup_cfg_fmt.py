@@ -1,19 +1,37 @@
 from __future__ import annotations
 
-import argparse
+import collections
 import configparser
-import glob
+import contextlib
+import contextvars
+import functools
 import io
+import itertools
+import math
 import os.path
 import re
 import string
+import sys
+import time
+from collections.abc import Callable
 from collections.abc import Generator
+from collections.abc import Iterable
+from collections.abc import Iterator
+from collections.abc import Mapping
 from collections.abc import Sequence
-from re import Match
+from typing import Any
+from typing import IO
+from typing import NamedTuple
+from typing import TYPE_CHECKING
+from typing import TypeVar
 
-from identify import identify
+if TYPE_CHECKING:
+    import argparse
+    import socketserver
 
 Version = tuple[int, ...]
+T = TypeVar('T')
+R = TypeVar('R')
 
 KEYS_ORDER: tuple[tuple[str, tuple[str, ...]], ...] = (
     (
@@ -52,39 +70,255 @@ class NoTransformConfigParser(configparser.RawConfigParser):
         return s
 
 
-def _adjacent_filename(setup_cfg: str, filename: str) -> str:
-    return os.path.join(os.path.dirname(setup_cfg), filename)
+def _fsync_dir(dirname: str) -> None:
+    """Make the renames in `dirname` durable."""
+    if sys.platform != 'win32':  # pragma: win32 no cover
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
-GLOB_PART = re.compile(r'(\[[^]]+\]|.)')
+def _fsync_files(filenames: list[str]) -> None:
+    # windows needs write access to flush, elsewhere read-only files work
+    flags = os.O_RDWR if sys.platform == 'win32' else os.O_RDONLY
+    for filename in filenames:
+        fd = os.open(filename, flags)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
+    for dirname in {os.path.dirname(os.path.realpath(f)) for f in filenames}:
+        _fsync_dir(dirname)
 
-def _case_insensitive_glob(s: str) -> str:
-    def cb(match: Match[str]) -> str:
-        match_s = match[0]
-        if len(match_s) == 1:
-            return f'[{match_s.upper()}{match_s.lower()}]'
+
+def _chown_like(path: str, st: os.stat_result) -> bool:
+    """Give `path` the owner of `st`, returns whether that was possible."""
+    path_st = os.stat(path)
+    if (path_st.st_uid, path_st.st_gid) == (st.st_uid, st.st_gid):
+        return True
+
+    try:
+        os.chown(path, st.st_uid, st.st_gid)
+    except PermissionError:
+        return False
+    else:
+        return True
+
+
+class FileSystem:
+    """The filesystem access needed to format a setup.cfg.
+
+    Each operation is counted in `counts` by `(operation, path)`.
+    """
+
+    def __init__(self) -> None:
+        self.counts: collections.Counter[tuple[str, str]]
+        self.counts = collections.Counter()
+        # read to be hashed, decoded instead of read again if read as text
+        self._read: dict[str, bytes] = {}
+
+    def list_files(self, dirname: str) -> list[str]:
+        self.counts['list_files', dirname] += 1
+        with os.scandir(dirname or '.') as it:
+            return [entry.name for entry in it if entry.is_file()]
+
+    def stat(self, path: str) -> os.stat_result | None:
+        """None when not available, the contents are compared instead"""
+        self.counts['stat', path] += 1
+        return os.stat(path)
+
+    def read_bytes(self, path: str) -> bytes:
+        self.counts['read', path] += 1
+        with open(path, 'rb') as f:
+            self._read[path] = contents = f.read()
+        return contents
+
+    def read_text(
+            self,
+            path: str,
+            *,
+            encoding: str | None = None,
+            size: int = -1,
+    ) -> str:
+        contents = self._read.pop(path, None)
+        if contents is not None:  # decoded like `open` would
+            with io.TextIOWrapper(io.BytesIO(contents), encoding) as f:
+                return f.read(size)
+
+        self.counts['read', path] += 1
+        with open(path, encoding=encoding) as f:
+            return f.read(size)
+
+    def write_text(
+            self,
+            path: str,
+            contents: str,
+            *,
+            fsync: bool = False,
+    ) -> None:
+        """Atomically replace `path` (keeping its permissions and owner).
+
+        When a temporary file cannot be created next to `path` or the owner
+        cannot be kept `path` is rewritten in place instead.
+        """
+        import errno
+        import stat
+        import tempfile
+
+        def _write(f: IO[str]) -> None:
+            f.write(contents)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.counts['write', path] += 1
+        self._read.pop(path, None)
+        # replace the target of a symlink rather than the symlink itself
+        path = os.path.realpath(path)
+        # like `open(path, 'w')`, refuse to replace a read-only file
+        if not os.access(path, os.W_OK):
+            msg = os.strerror(errno.EACCES)
+            raise PermissionError(errno.EACCES, msg, path)
+        st = os.stat(path)
+
+        dirname, basename = os.path.split(path)
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=dirname, prefix=f'.{basename}.', suffix='.tmp',
+            )
+        except PermissionError:  # a writable file in a read-only directory
+            in_place = True
         else:
-            inner = ''.join(f'{c.upper()}{c.lower()}' for c in match_s[1:-1])
-            return f'[{inner}]'
+            try:
+                with open(fd, 'w') as f:
+                    _write(f)
+                os.chmod(tmp, stat.S_IMODE(st.st_mode))
+                # such as another user's file in a shared tree
+                in_place = not _chown_like(tmp, st)
+                if not in_place:
+                    os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            if in_place:
+                os.remove(tmp)
+
+        if in_place:
+            with open(path, 'w') as f:
+                _write(f)
+        elif fsync:
+            _fsync_dir(dirname)
+
+
+class MemoryFileSystem(FileSystem):
+    """A `FileSystem` of `{path: contents}` held in memory."""
+
+    def __init__(self, files: Mapping[str, str]) -> None:
+        super().__init__()
+        self.files = dict(files)
+
+    def _contents(self, path: str) -> str:
+        try:
+            return self.files[path]
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def list_files(self, dirname: str) -> list[str]:
+        self.counts['list_files', dirname] += 1
+        return [
+            os.path.basename(path)
+            for path in self.files
+            if os.path.dirname(path) == dirname
+        ]
 
-    return GLOB_PART.sub(cb, s)
+    def stat(self, path: str) -> os.stat_result | None:
+        self.counts['stat', path] += 1
+        return None
 
+    def read_bytes(self, path: str) -> bytes:
+        self.counts['read', path] += 1
+        return self._contents(path).encode()
+
+    def read_text(
+            self,
+            path: str,
+            *,
+            encoding: str | None = None,
+            size: int = -1,
+    ) -> str:
+        self.counts['read', path] += 1
+        contents = self._contents(path)
+        return contents if size < 0 else contents[:size]
+
+    def write_text(
+            self,
+            path: str,
+            contents: str,
+            *,
+            fsync: bool = False,
+    ) -> None:
+        self.counts['write', path] += 1
+        self.files[path] = contents
+
+
+class Project:
+    """The files adjacent to a setup.cfg, listed once."""
+
+    def __init__(self, setup_cfg: str, fs: FileSystem | None = None) -> None:
+        self.dirname = os.path.dirname(setup_cfg)
+        self.fs = FileSystem() if fs is None else fs
+        self.files = {
+            name: name.lower() for name in self.fs.list_files(self.dirname)
+        }
+
+    @classmethod
+    def from_files(cls, files: Mapping[str, str]) -> Project:
+        """A project of in-memory `{filename: contents}` (LICENSE, ...)"""
+        return cls('setup.cfg', MemoryFileSystem(files))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dirname, name)
+
+    def file(self, name: str) -> str | None:
+        if name in self.files:
+            return self._path(name)
+        else:
+            return None
+
+    def first_file(self, *prefixes: str) -> str | None:
+        """Find a file starting with one of `prefixes` (case insensitive)."""
+        # prefer non-asciidoc because pypi does not render it
+        # https://github.com/asottile/setup-cfg-fmt/issues/149
+        def sort_key(filename: str) -> tuple[bool, str]:
+            return (filename.endswith(('.adoc', '.asciidoc')), filename)
+
+        found = [
+            name for name, lower in self.files.items()
+            if lower.startswith(prefixes)
+        ]
+        if found:
+            return self._path(min(found, key=sort_key))
+        else:
+            return None
 
-def _first_file(setup_cfg: str, prefix: str) -> str | None:
-    prefix = _case_insensitive_glob(prefix)
-    path = _adjacent_filename(setup_cfg, prefix)
+    @property
+    def readme(self) -> str | None:
+        return self.first_file('readme')
 
-    # prefer non-asciidoc because pypi does not render it
-    # https://github.com/asottile/setup-cfg-fmt/issues/149
-    def sort_key(filename: str) -> tuple[bool, str]:
-        return (filename.endswith(('.adoc', '.asciidoc')), filename)
+    @property
+    def license(self) -> str | None:
+        return self.first_file('license', 'licence')
 
-    for filename in sorted(glob.iglob(f'{path}*'), key=sort_key):
-        if os.path.isfile(filename):
-            return filename
-    else:
-        return None
+    @functools.cached_property
+    def tox_envs(self) -> tuple[str, ...]:
+        tox_ini = self.file('tox.ini')
+        if tox_ini is None:
+            return ()
+        else:
+            return tuple(dict.fromkeys(_tox_envlist(tox_ini, self.fs)))
 
 
 def _parse_list(s: str) -> list[str]:
@@ -143,16 +377,62 @@ def _parse_python_requires(
     return minimum, excluded
 
 
-def _tox_envlist(setup_cfg: str) -> Generator[str]:
-    tox_ini = _adjacent_filename(setup_cfg, 'tox.ini')
-    if os.path.exists(tox_ini):
-        cfg = NoTransformConfigParser()
-        cfg.read(tox_ini)
+def _split_unbraced(s: str, seps: str) -> list[str]:
+    """Split `s` on `seps`, ignoring separators inside of `{...}`."""
+    parts = []
+    depth = 0
+    part_start = 0
+    for i, c in enumerate(s):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif depth == 0 and c in seps:
+            parts.append(s[part_start:i])
+            part_start = i + 1
+    parts.append(s[part_start:])
+    return parts
+
+
+TOX_BRACES = re.compile(r'\{([^{}]*)\}')
+
+
+def _brace_choices(s: str) -> list[str]:
+    choices: list[str] = []
+    for choice in s.split(','):
+        choice = choice.strip()
+        start, dash, end = choice.partition('-')
+        if dash and start.isdigit() and end.isdigit():  # py3{10-13}
+            choices.extend(str(n) for n in range(int(start), int(end) + 1))
+        else:
+            choices.append(choice)
+    return choices
+
+
+def _expand_braces(s: str) -> Generator[str]:
+    """Expand tox's generative syntax: py{39,310} => py39, py310"""
+    parts = TOX_BRACES.split(s)
+    choices = [
+        _brace_choices(part) if i % 2 else [part]
+        for i, part in enumerate(parts)
+    ]
+    for combination in itertools.product(*choices):
+        yield ''.join(combination)
 
-        envlist = cfg.get('tox', 'envlist', fallback='')
-        if envlist:
-            for env in envlist.split(','):
-                env, _, _ = env.strip().partition('-')  # py36-foo
+
+def _tox_envlist(tox_ini: str, fs: FileSystem) -> Generator[str]:
+    """Yields the first factor of each env: py39-django40 => py39"""
+    cfg = NoTransformConfigParser()
+    cfg.read_string(fs.read_text(tox_ini), tox_ini)
+
+    envlist = cfg.get('tox', 'envlist', fallback='')
+    for env in _split_unbraced(envlist, ',\n'):
+        # only the first factor is needed, so avoid expanding the rest of
+        # the matrix: py{39,310}-django{40,50} => py{39,310}
+        first_factor = _split_unbraced(env.strip(), '-')[0]
+        for expanded in _expand_braces(first_factor):
+            env, _, _ = expanded.partition('-')  # py{39-foo,310}
+            if env:
                 yield env
 
 
@@ -160,10 +440,11 @@ TOX_ENV = re.compile(r'py3(\d+)')
 
 
 def _python_requires(
-        setup_cfg: str, *, min_py_version: tuple[int, int] | None,
+        cfg: NoTransformConfigParser,
+        project: Project,
+        *,
+        min_py_version: tuple[int, int] | None,
 ) -> str | None:
-    cfg = NoTransformConfigParser()
-    cfg.read(setup_cfg)
     current_value = cfg.get('options', 'python_requires', fallback='')
     classifiers = cfg.get('metadata', 'classifiers', fallback='')
 
@@ -172,7 +453,7 @@ def _python_requires(
     except UnknownVersionError:  # assume they know what's up with weird things
         return current_value
 
-    for env in _tox_envlist(setup_cfg):
+    for env in project.tox_envs:
         match = TOX_ENV.match(env)
         if match:
             version = _to_ver(f'3.{match[1]}')
@@ -206,100 +487,266 @@ def _requires(
     if not require_group:
         return []
 
-    return sorted(
-        (_normalize_req(req) for req in require_group),
-        key=lambda req: (';' in req, _req_base(req), req),
+    reqs = [_parse_requirement(line) for line in require_group if line]
+    reqs.sort(key=lambda req: req.sort_key)
+    return [req.text for req in reqs]
+
+
+REQ_NAME_CHARS = frozenset(string.ascii_letters + string.digits + '._-')
+# longest first so `===` isn't read as `==`
+REQ_OPS = ('===', '==', '!=', '~=', '<=', '>=', '<', '>')
+REQ_VERSION_END = frozenset(' \t,;)')
+
+
+class _Requirement:
+    """A PEP 508 requirement, normalized: `name[extras]specs;marker`"""
+
+    __slots__ = (
+        'name', 'extras', 'specifiers', 'url', 'marker', 'text', 'sort_key',
     )
 
+    def __init__(
+            self,
+            name: str,
+            extras: tuple[str, ...],
+            specifiers: tuple[str, ...],
+            url: str | None,
+            marker: str | None,
+    ) -> None:
+        self.name = name
+        self.extras = extras
+        # conditions with upper bounds last: !=1,>=1,<2
+        self.specifiers = tuple(
+            sorted(specifiers, key=lambda c: ('<' in c, '>' in c, c)),
+        )
+        self.url = url
+        self.marker = marker
+
+        base = f'{name}[{",".join(extras)}]' if extras else name
+        if url is not None:
+            text = f'{base}@{url}'
+            # pep 508 requires whitespace between a url and a marker
+            sep = ' ;'
+        else:
+            text = f'{base}{",".join(self.specifiers)}'
+            sep = ';'
+        if marker is not None:
+            text = f'{text}{sep}{marker}'
 
-def _normalize_req(req: str) -> str:
-    lib, _, envs = req.partition(';')
-    normalized = _normalize_lib(lib)
+        self.text = text
+        self.sort_key = (marker is not None, base, text)
 
-    envs = envs.strip()
-    if not envs:
-        return normalized
 
-    return f'{normalized};{envs}'
+def _parse_requirement(s: str) -> _Requirement:
+    """Tokenize a requirement in a single pass.
 
+    Lines which aren't valid requirements are kept as they are.
+    """
+    n = len(s)
 
-BASE_NAME_REGEX = re.compile(r'[^!=><\s@~]+')
-REQ_REGEX = re.compile(r'(===|==|!=|~=|>=?|<=?|@)\s*([^,]+)')
+    def _skip_ws(i: int) -> int:
+        while i < n and s[i] in ' \t':
+            i += 1
+        return i
 
+    def _marker(i: int) -> str | None:
+        if i == n:
+            return None
+        elif s[i] != ';':
+            raise ValueError(i)
+        else:
+            return s[i + 1:].strip() or None
 
-def _normalize_lib(lib: str) -> str:
-    base = _req_base(lib)
+    try:
+        i = _skip_ws(0)
+        start = i
+        while i < n and s[i] in REQ_NAME_CHARS:
+            i += 1
+        if i == start:
+            raise ValueError(i)
+        # pip replaces _ with - in package names
+        name = s[start:i].replace('_', '-')
+
+        i = _skip_ws(i)
+        extras: tuple[str, ...] = ()
+        if i < n and s[i] == '[':
+            end = s.find(']', i)
+            if end == -1:
+                raise ValueError(i)
+            extras = tuple(
+                extra.strip().replace('_', '-')
+                for extra in s[i + 1:end].split(',')
+                if extra.strip()
+            )
+            i = _skip_ws(end + 1)
+
+        if i < n and s[i] == '@':
+            start = i = _skip_ws(i + 1)
+            while i < n and s[i] not in ' \t':
+                i += 1
+            if i == start:
+                raise ValueError(i)
+            url = s[start:i]
+            marker = _marker(_skip_ws(i))
+            return _Requirement(name, extras, (), url, marker)
+
+        parenthesized = i < n and s[i] == '('
+        if parenthesized:
+            i += 1
+
+        specifiers = []
+        while True:
+            i = _skip_ws(i)
+            if i == n or s[i] in ';)':
+                break
+            for op in REQ_OPS:
+                if s.startswith(op, i):
+                    break
+            else:
+                raise ValueError(i)
+            start = i = _skip_ws(i + len(op))
+            while i < n and s[i] not in REQ_VERSION_END:
+                i += 1
+            if i == start:
+                raise ValueError(i)
+            specifiers.append(f'{op}{s[start:i]}')
+
+            i = _skip_ws(i)
+            if i < n and s[i] == ',':
+                i += 1
+            else:
+                break
+
+        if parenthesized:
+            if i == n or s[i] != ')':
+                raise ValueError(i)
+            i = _skip_ws(i + 1)
+
+        marker = _marker(i)
+    except ValueError:
+        return _Requirement(s, (), (), None, None)
+    else:
+        return _Requirement(name, extras, tuple(specifiers), None, marker)
+
+
+PY_CLASSIFIER = 'Programming Language :: Python :: '
 
-    conditions = ','.join(
-        sorted(
-            (f'{m[1]}{m[2]}' for m in REQ_REGEX.finditer(lib)),
-            key=lambda c: ('<' in c, '>' in 'c', c),
-        ),
-    )
 
-    return f'{base}{conditions}'
+class _PyClassifierTable(NamedTuple):
+    minors: tuple[str, ...]  # 3.x classifier by x, up to the maximum
+    major: str  # the 3 classifier
+    versions: dict[str, Version]  # classifier => version, including 2.x
 
 
-def _req_base(lib: str) -> str:
-    basem = re.match(BASE_NAME_REGEX, lib)
-    assert basem
-    # pip replaces _ with - in package names
-    return basem[0].replace('_', '-')
+@functools.cache
+def _py_classifier_table(
+        max_py_version: tuple[int, int],
+) -> _PyClassifierTable:
+    minors = tuple(
+        f'{PY_CLASSIFIER}3.{n}' for n in range(max_py_version[1] + 1)
+    )
+    versions: dict[str, Version] = {f'{PY_CLASSIFIER}2': (2,)}
+    versions.update((f'{PY_CLASSIFIER}2.{n}', (2, n)) for n in range(8))
+    versions[f'{PY_CLASSIFIER}3'] = (3,)
+    versions.update((s, (3, n)) for n, s in enumerate(minors))
+    return _PyClassifierTable(minors, f'{PY_CLASSIFIER}3', versions)
+
+
+def _py_version_mask(
+        minimum: Version,
+        exclude: set[Version],
+        *,
+        max_py_version: tuple[int, int],
+) -> int:
+    """bitset of the allowed 3.x minor versions (bit x => 3.x)"""
+    if minimum[0] > 3:
+        return 0
+    low = minimum[1] if minimum[0] == 3 else 0
+    mask = (1 << max_py_version[1] + 1) - (1 << low)
+    for version in exclude:
+        if len(version) == 2 and version[0] == 3:
+            mask &= ~(1 << version[1])
+    return mask
 
 
 def _py_classifiers(
-        python_requires: str | None, *, max_py_version: tuple[int, int],
+        python_requires: tuple[Version | None, set[Version]] | None,
+        *,
+        max_py_version: tuple[int, int],
 ) -> list[str]:
-    try:
-        minimum, exclude = _parse_python_requires(python_requires)
-    except UnknownVersionError:
+    if python_requires is None:
         return []
-
+    minimum, exclude = python_requires
     if minimum is None:  # don't have a sequence of versions to iterate over
         return []
-    else:
-        # classifiers only use the first two segments of version
-        minimum = minimum[:2]
-
-    versions: set[Version] = set()
-    while minimum <= max_py_version:
-        if minimum not in exclude:
-            versions.add(minimum)
-            versions.add(minimum[:1])
-        minimum = (minimum[0], minimum[1] + 1)
 
+    table = _py_classifier_table(max_py_version)
+    mask = _py_version_mask(minimum, exclude, max_py_version=max_py_version)
     classifiers = [
-        f'Programming Language :: Python :: {_v(v)}' for v in versions
+        classifier
+        for n, classifier in enumerate(table.minors)
+        if mask >> n & 1
     ]
+    if classifiers:
+        classifiers.append(table.major)
     classifiers.append('Programming Language :: Python :: 3 :: Only')
 
     return classifiers
 
 
+@functools.cache
+def _rejected_py_classifiers(
+        mask: int,
+        *,
+        include_version_classifiers: bool,
+        max_py_version: tuple[int, int],
+) -> frozenset[str]:
+    """the classifiers in the table which don't match the allowed versions"""
+    table = _py_classifier_table(max_py_version)
+    rejected = set(table.versions) - {table.major}
+    if include_version_classifiers:
+        rejected.difference_update(
+            classifier
+            for n, classifier in enumerate(table.minors)
+            if mask >> n & 1
+        )
+    return frozenset(rejected)
+
+
 def _trim_py_classifiers(
         classifiers: list[str],
-        python_requires: str | None,
+        python_requires: tuple[Version | None, set[Version]] | None,
         *,
         include_version_classifiers: bool,
         max_py_version: tuple[int, int],
 ) -> list[str]:
-    try:
-        minimum, exclude = _parse_python_requires(python_requires)
-    except UnknownVersionError:
+    if python_requires is None:
         return classifiers
+    minimum, exclude = python_requires
+    if minimum is None:  # can't know if it applies without a minimum
+        return classifiers
+
+    table = _py_classifier_table(max_py_version)
+    rejected = _rejected_py_classifiers(
+        _py_version_mask(minimum, exclude, max_py_version=max_py_version),
+        include_version_classifiers=include_version_classifiers,
+        max_py_version=max_py_version,
+    )
 
     def _is_ok_classifier(s: str) -> bool:
-        parts = s.split(' :: ')
-        if (
-                # can't know if it applies without a minimum
-                minimum is None or
-                # handle Python :: 3 :: Only
-                len(parts) != 3 or
-                not s.startswith('Programming Language :: Python :: ')
-        ):
+        if s in table.versions:
+            return s not in rejected
+        elif not s.startswith(PY_CLASSIFIER) or s.count(' :: ') != 2:
+            return True
+
+        # uncommon versions: 3.x.y, 4, ...
+        try:
+            ver = tuple(
+                int(p) for p in s[len(PY_CLASSIFIER):].strip().split('.')
+            )
+        except ValueError:  # Python :: Implementation
             return True
 
-        ver = tuple(int(p) for p in parts[-1].strip().split('.'))
         size = len(ver)
         return (
             ver >= (3,) and ver not in exclude and (
@@ -313,10 +760,10 @@ def _trim_py_classifiers(
     return [s for s in classifiers if _is_ok_classifier(s)]
 
 
-def _imp_classifiers(setup_cfg: str) -> list[str]:
+def _imp_classifiers(project: Project) -> list[str]:
     classifiers = set()
 
-    for env in _tox_envlist(setup_cfg):
+    for env in project.tox_envs:
         # remove trailing digits: py39-django31
         classifier = TOX_TO_CLASSIFIERS.get(env.rstrip(string.digits))
         if classifier is not None:
@@ -325,45 +772,332 @@ def _imp_classifiers(setup_cfg: str) -> list[str]:
     return sorted(classifiers)
 
 
+# mirrors the normalization done by `identify.license_id`
+COPYRIGHT_RE = re.compile(r'^\s*(Copyright|\(C\)) .*$', re.I | re.MULTILINE)
+WS_RE = re.compile(r'\s+')
+
+# no known license text is anywhere near this large
+LICENSE_MAX_SIZE = 1024 * 1024
+# fuzzy matching compares against the licenses sharing the most shingles
+LICENSE_SHINGLE_SIZE = 5
+LICENSE_CANDIDATES = 3
+
+# normalized license digest => spdx id, shared by every file in this process
+_LICENSE_IDS: dict[str, str | None] = {}
+
+
+def _norm_license(s: str) -> str:
+    s = COPYRIGHT_RE.sub('', s)
+    s = WS_RE.sub(' ', s)
+    return s.strip()
+
+
+def _shingles(norm: str) -> set[int]:
+    words = norm.split(' ')
+    n = LICENSE_SHINGLE_SIZE
+    return {hash(tuple(words[i:i + n])) for i in range(len(words) - n + 1)}
+
+
+@functools.cache
+def _normed_licenses() -> tuple[tuple[str, str], ...]:
+    from identify.vendor import licenses
+
+    return tuple(
+        (spdx, _norm_license(text)) for spdx, text in licenses.LICENSES
+    )
+
+
+@functools.cache
+def _exact_license_ids() -> dict[str, str]:
+    import hashlib
+
+    ret: dict[str, str] = {}
+    for spdx, norm in _normed_licenses():
+        ret.setdefault(hashlib.sha256(norm.encode()).hexdigest(), spdx)
+    return ret
+
+
+@functools.cache
+def _license_shingles() -> dict[int, list[int]]:
+    """word shingle => indices of the licenses containing it"""
+    ret: dict[int, list[int]] = collections.defaultdict(list)
+    for i, (_, norm) in enumerate(_normed_licenses()):
+        for shingle in _shingles(norm):
+            ret[shingle].append(i)
+    return ret
+
+
+def _shingle_candidates(norm: str, eligible: list[int]) -> list[int]:
+    """the few `eligible` licenses sharing the most shingles with `norm`"""
+    license_shingles = _license_shingles()
+    eligible_set = set(eligible)
+
+    counts: collections.Counter[int] = collections.Counter()
+    for shingle in _shingles(norm):
+        counts.update(
+            i for i in license_shingles.get(shingle, ()) if i in eligible_set
+        )
+    return sorted(i for i, _ in counts.most_common(LICENSE_CANDIDATES))
+
+
+def _fuzzy_license_id(norm: str) -> str | None:
+    """An approximation of the edit distance search of `identify.license_id`.
+
+    Licenses of a similar length are compared directly when there are only
+    a few of them, otherwise only the ones sharing the most word shingles
+    with the license text are compared.
+    """
+    import ukkonen
+
+    if not norm:
+        return None
+
+    licenses = _normed_licenses()
+
+    candidates = [
+        i for i, (_, text) in enumerate(licenses)
+        # same rule as identify: lengths must be within 5%
+        if abs(len(norm) - len(text)) / len(norm) <= .05
+    ]
+    # building the shingle index costs more than a few comparisons
+    if len(candidates) > LICENSE_CANDIDATES:
+        candidates = _shingle_candidates(norm, candidates)
+
+    cutoff = math.ceil(.05 * len(norm))
+    min_edit_dist = cutoff
+    min_edit_dist_spdx = None
+    for i in candidates:
+        spdx, text = licenses[i]
+        edit_dist = ukkonen.distance(norm, text, cutoff)
+        if edit_dist < min_edit_dist:
+            min_edit_dist = edit_dist
+            min_edit_dist_spdx = spdx
+
+    return min_edit_dist_spdx
+
+
+@functools.cache
+def _source_digest() -> str:
+    """Changes with any change to this tool, such as the license matcher."""
+    import hashlib
+
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _license_id(
+        filename: str,
+        fs: FileSystem,
+        *,
+        license_db: str | None,
+) -> str | None:
+    contents = fs.read_text(
+        filename, encoding='UTF-8', size=LICENSE_MAX_SIZE + 1,
+    )
+    if len(contents) > LICENSE_MAX_SIZE:
+        return None
+
+    import hashlib
+
+    norm = _norm_license(contents)
+    digest = hashlib.sha256(norm.encode()).hexdigest()
+    try:
+        return _LICENSE_IDS[digest]
+    except KeyError:
+        pass
+
+    # most license files are verbatim copies, avoid the edit distance search
+    exact = _exact_license_ids().get(digest)
+    if exact is not None:
+        _LICENSE_IDS[digest] = exact
+        return exact
+
+    if license_db is not None:
+        import importlib.metadata
+        import sqlite3
+
+        key = (
+            _source_digest(), importlib.metadata.version('identify'), digest,
+        )
+        os.makedirs(os.path.dirname(license_db), exist_ok=True)
+        with contextlib.closing(sqlite3.connect(license_db, timeout=30)) as db:
+            with db:
+                db.execute(
+                    'CREATE TABLE IF NOT EXISTS license_ids ('
+                    '    source_digest TEXT NOT NULL,'
+                    '    identify_version TEXT NOT NULL,'
+                    '    digest TEXT NOT NULL,'
+                    '    spdx TEXT,'
+                    '    PRIMARY KEY (source_digest, identify_version, digest)'
+                    ')',
+                )
+            row = db.execute(
+                'SELECT spdx FROM license_ids '
+                'WHERE source_digest = ? AND identify_version = ? '
+                'AND digest = ?',
+                key,
+            ).fetchone()
+            if row is not None:
+                license_id, = row
+            else:
+                license_id = _fuzzy_license_id(norm)
+                with db:
+                    db.execute(
+                        'INSERT OR REPLACE INTO license_ids '
+                        'VALUES (?, ?, ?, ?)',
+                        (*key, license_id),
+                    )
+    else:
+        license_id = _fuzzy_license_id(norm)
+
+    _LICENSE_IDS[digest] = license_id
+    return license_id
+
+
+@functools.lru_cache(maxsize=4096)
+def _natural_key(s: str) -> tuple[str | int, ...]:
+    """`s` split into alternating runs of text and digits (as numbers)"""
+    parts: list[str | int] = []
+    start = 0
+    digits = False
+    for i, c in enumerate(s):
+        if c.isdecimal() is not digits:
+            part = s[start:i]
+            parts.append(int(part) if digits else part.lower())
+            start, digits = i, not digits
+    if digits:
+        parts.extend((int(s[start:]), ''))
+    else:
+        parts.append(s[start:].lower())
+    return tuple(parts)
+
+
 def _natural_sort(items: Sequence[str]) -> list[str]:
-    return sorted(
-        set(items),
-        key=lambda s: [
-            int(part) if part.isdigit() else part.lower()
-            for part in re.split(r'(\d+)', s)
-        ],
+    return sorted(set(items), key=_natural_key)
+
+
+def _is_known_classifier(classifier: str) -> bool:
+    import trove_classifiers
+
+    return (
+        classifier in trove_classifiers.classifiers or
+        # reserved by pypi to prevent accidental uploads
+        classifier.startswith('Private :: ')
     )
 
 
-def format_file(
-        filename: str, *,
+class Span(NamedTuple):
+    """a timed phase of formatting `filename`"""
+    name: str
+    filename: str
+    start: float  # `time.perf_counter()` seconds
+    duration: float
+    pid: int
+    tid: int
+
+
+FILE_SPAN = 'format_file'
+
+_span_hooks: list[Callable[[Span], None]] = []
+
+
+def add_span_hook(hook: Callable[[Span], None]) -> None:
+    """call `hook` with each `Span` once a file has been formatted"""
+    _span_hooks.append(hook)
+
+
+def remove_span_hook(hook: Callable[[Span], None]) -> None:
+    _span_hooks.remove(hook)
+
+
+def _emit_spans(spans: list[Span]) -> None:
+    for hook in tuple(_span_hooks):
+        for span in spans:
+            hook(span)
+
+
+# spans, filename, pid, tid of the file being formatted, only when recording
+# (per context, files may be formatted in several threads)
+_recorder: contextvars.ContextVar[tuple[list[Span], str, int, int] | None]
+_recorder = contextvars.ContextVar('_recorder', default=None)
+
+
+@contextlib.contextmanager
+def _phase(name: str) -> Generator[None]:
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+    else:
+        spans, filename, pid, tid = recorder
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - t0
+            spans.append(Span(name, filename, t0, duration, pid, tid))
+
+
+@contextlib.contextmanager
+def _recording(filename: str, enabled: bool) -> Generator[list[Span]]:
+    spans: list[Span] = []
+    if enabled:
+        import threading
+
+        recorder = (spans, filename, os.getpid(), threading.get_native_id())
+    else:
+        recorder = None
+    token = _recorder.set(recorder)
+    try:
+        with _phase(FILE_SPAN):
+            yield spans
+    finally:
+        _recorder.reset(token)
+
+
+def format_string(
+        contents: str,
+        *,
+        context: Project | None = None,
         include_version_classifiers: bool,
         min_py_version: tuple[int, int] | None,
         max_py_version: tuple[int, int],
-) -> bool:
-    with open(filename) as f:
-        contents = f.read()
-
-    cfg = NoTransformConfigParser()
-    cfg.read_string(contents)
-    _clean_sections(cfg)
+        license_db: str | None = None,
+        on_unknown_classifier: Callable[[str], None] | None = None,
+) -> str:
+    """Format the contents of a setup.cfg.
+
+    `context` provides the files adjacent to it (README, LICENSE, tox.ini),
+    by default there are none.  `on_unknown_classifier` is called with each
+    classifier which is not a known trove classifier.
+    """
+    if context is None:
+        context = Project.from_files({})
+
+    with _phase('parse'):
+        cfg = NoTransformConfigParser()
+        cfg.read_string(contents)
+        _clean_sections(cfg)
 
     # normalize names to underscores so sdist / wheel have the same prefix
     cfg['metadata']['name'] = cfg['metadata']['name'].replace('-', '_')
 
     # if README exists, set `long_description` + content type
-    readme = _first_file(filename, 'readme')
-    if readme is not None:
-        long_description = f'file: {os.path.basename(readme)}'
-        cfg['metadata']['long_description'] = long_description
-
-        tags = identify.tags_from_filename(readme)
-        if 'markdown' in tags:
-            cfg['metadata']['long_description_content_type'] = 'text/markdown'
-        elif 'rst' in tags:
-            cfg['metadata']['long_description_content_type'] = 'text/x-rst'
-        else:
-            cfg['metadata']['long_description_content_type'] = 'text/plain'
+    with _phase('readme'):
+        readme = context.readme
+        if readme is not None:
+            long_description = f'file: {os.path.basename(readme)}'
+            cfg['metadata']['long_description'] = long_description
+
+            from identify import identify
+
+            tags = identify.tags_from_filename(readme)
+            if 'markdown' in tags:
+                content_type = 'text/markdown'
+            elif 'rst' in tags:
+                content_type = 'text/x-rst'
+            else:
+                content_type = 'text/plain'
+            cfg['metadata']['long_description_content_type'] = content_type
 
     classifiers = _parse_list(cfg['metadata'].get('classifiers', ''))
     licenses = _parse_list(cfg['metadata'].get('license_files', ''))
@@ -373,87 +1107,140 @@ def format_file(
         licenses.append(cfg['metadata'].pop('license_file'))
 
     # set license fields if a license exists
-    license_filename = _first_file(filename, 'licen[sc]e')
-    if license_filename is not None:
-        license_basename = os.path.basename(license_filename)
-        licenses.append(license_basename)
-
-        license_id = identify.license_id(license_filename)
-        if license_id is not None:
-            cfg['metadata']['license'] = license_id
+    with _phase('license'):
+        license_filename = context.license
+        if license_filename is not None:
+            license_basename = os.path.basename(license_filename)
+            licenses.append(license_basename)
+
+            license_id = _license_id(
+                license_filename, context.fs, license_db=license_db,
+            )
+            if license_id is not None:
+                cfg['metadata']['license'] = license_id
 
     # sort license_files if it exists
     if licenses:
         cfg['metadata']['license_files'] = _fmt_list(sorted(set(licenses)))
 
-    requires = _python_requires(filename, min_py_version=min_py_version)
-    if requires is not None:
-        if not cfg.has_section('options'):
-            cfg.add_section('options')
-        cfg['options']['python_requires'] = requires
-
-    install_requires = _requires(cfg, 'install_requires')
-    if install_requires:
-        cfg['options']['install_requires'] = _fmt_list_always(install_requires)
+    with _phase('tox'):
+        context.tox_envs
 
-    setup_requires = _requires(cfg, 'setup_requires')
-    if setup_requires:
-        cfg['options']['setup_requires'] = _fmt_list_always(setup_requires)
+    with _phase('python_requires'):
+        requires = _python_requires(
+            cfg, context, min_py_version=min_py_version,
+        )
+        if requires is not None:
+            if not cfg.has_section('options'):
+                cfg.add_section('options')
+            cfg['options']['python_requires'] = requires
+
+    with _phase('requires'):
+        install_requires = _requires(cfg, 'install_requires')
+        if install_requires:
+            cfg['options']['install_requires'] = _fmt_list_always(
+                install_requires,
+            )
 
-    if cfg.has_section('options.extras_require'):
-        for key in cfg['options.extras_require']:
-            cfg['options.extras_require'][key] = _fmt_list_always(
-                _requires(cfg, key, 'options.extras_require'),
+        setup_requires = _requires(cfg, 'setup_requires')
+        if setup_requires:
+            cfg['options']['setup_requires'] = _fmt_list_always(
+                setup_requires,
             )
 
-    py_classifiers = _py_classifiers(requires, max_py_version=max_py_version)
-    classifiers.extend(py_classifiers)
-    classifiers.extend(_imp_classifiers(filename))
+        if cfg.has_section('options.extras_require'):
+            for key in cfg['options.extras_require']:
+                cfg['options.extras_require'][key] = _fmt_list_always(
+                    _requires(cfg, key, 'options.extras_require'),
+                )
 
-    # sort the classifiers if present
-    if classifiers:
-        classifiers = _trim_py_classifiers(
-            _natural_sort(classifiers),
-            requires,
-            max_py_version=max_py_version,
-            include_version_classifiers=include_version_classifiers,
+    with _phase('classifiers'):
+        try:
+            parsed_requires = _parse_python_requires(requires)
+        except UnknownVersionError:
+            parsed_requires = None
+
+        classifiers.extend(
+            _py_classifiers(parsed_requires, max_py_version=max_py_version),
         )
-        classifiers = [
-            s for s in classifiers if not s.startswith('License ::')
-        ]
-        cfg['metadata']['classifiers'] = _fmt_list_always(classifiers)
+        classifiers.extend(_imp_classifiers(context))
+
+        # sort the classifiers if present
+        if classifiers:
+            classifiers = _trim_py_classifiers(
+                _natural_sort(classifiers),
+                parsed_requires,
+                max_py_version=max_py_version,
+                include_version_classifiers=include_version_classifiers,
+            )
+            classifiers = [
+                s for s in classifiers if not s.startswith('License ::')
+            ]
+            cfg['metadata']['classifiers'] = _fmt_list_always(classifiers)
+
+            if on_unknown_classifier is not None:
+                for classifier in classifiers:
+                    if not _is_known_classifier(classifier):
+                        on_unknown_classifier(classifier)
+
+    with _phase('serialize'):
+        sections: dict[str, dict[str, str]] = {}
+        for section, key_order in KEYS_ORDER:
+            if section not in cfg:
+                continue
 
-    sections: dict[str, dict[str, str]] = {}
-    for section, key_order in KEYS_ORDER:
-        if section not in cfg:
-            continue
+            entries = {
+                k.replace('-', '_'): v for k, v in cfg[section].items()
+            }
+
+            new_section = {
+                k: entries.pop(k) for k in key_order if k in entries
+            }
+            # sort any remaining keys
+            new_section.update(sorted(entries.items()))
 
-        entries = {k.replace('-', '_'): v for k, v in cfg[section].items()}
+            sections[section] = new_section
+            cfg.pop(section)
 
-        new_section = {k: entries.pop(k) for k in key_order if k in entries}
-        # sort any remaining keys
-        new_section.update(sorted(entries.items()))
+        for section in cfg.sections():
+            sections[section] = dict(cfg[section])
+            cfg.pop(section)
 
-        sections[section] = new_section
-        cfg.pop(section)
+        for k, v in sections.items():
+            cfg[k] = v
 
-    for section in cfg.sections():
-        sections[section] = dict(cfg[section])
-        cfg.pop(section)
+        sio = io.StringIO()
+        cfg.write(sio)
+        new_contents = sio.getvalue().strip() + '\n'
+        new_contents = new_contents.replace('\t', '    ')
+        return new_contents.replace(' \n', '\n')
 
-    for k, v in sections.items():
-        cfg[k] = v
 
-    sio = io.StringIO()
-    cfg.write(sio)
-    new_contents = sio.getvalue().strip() + '\n'
-    new_contents = new_contents.replace('\t', '    ')
-    new_contents = new_contents.replace(' \n', '\n')
+def format_file(
+        filename: str, *,
+        include_version_classifiers: bool,
+        min_py_version: tuple[int, int] | None,
+        max_py_version: tuple[int, int],
+        license_db: str | None = None,
+        fs: FileSystem | None = None,
+) -> bool:
+    with _recording(filename, bool(_span_hooks)) as spans:
+        project = Project(filename, fs)
+        contents = project.fs.read_text(filename)
 
-    if new_contents != contents:
-        with open(filename, 'w') as f:
-            f.write(new_contents)
+        new_contents = format_string(
+            contents,
+            context=project,
+            include_version_classifiers=include_version_classifiers,
+            min_py_version=min_py_version,
+            max_py_version=max_py_version,
+            license_db=license_db,
+        )
 
+        if new_contents != contents:
+            project.fs.write_text(filename, new_contents)
+
+    _emit_spans(spans)
     return new_contents != contents
 
 
@@ -467,7 +1254,522 @@ def _clean_sections(cfg: NoTransformConfigParser) -> None:
             cfg.pop(section)
 
 
+def _cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'setup-cfg-fmt')
+
+
+class _ResultCache:
+    """Remembers which setup.cfg files are already formatted.
+
+    Entries are empty files named by a digest of everything that can affect
+    the output: the contents of setup.cfg and the files adjacent to it, the
+    options, and the version of this tool.  A second entry keyed on the
+    `stat` of those inputs (if the file system has it) allows skipping the
+    hashing entirely when nothing was touched.
+    """
+
+    MAX_ENTRIES = 8192
+
+    def __init__(self, directory: str, options: tuple[object, ...]) -> None:
+        import importlib.metadata
+
+        source_digest = _source_digest()
+        identify_version = importlib.metadata.version('identify')
+        trove_version = importlib.metadata.version('trove-classifiers')
+
+        self.directory = directory
+        self.key = repr(
+            (source_digest, identify_version, trove_version, options),
+        )
+        # entries computed by a missed lookup, reused if the file is unchanged
+        self._missed: dict[str, tuple[str | None, str]] = {}
+
+    def _inputs(self, filename: str, project: Project) -> list[str]:
+        inputs = [
+            filename,
+            project.readme,
+            project.license,
+            project.file('tox.ini'),
+        ]
+        return [path for path in inputs if path is not None]
+
+    def _entry(self, kind: str, parts: list[bytes]) -> str:
+        import hashlib
+
+        h = hashlib.sha256(self.key.encode())
+        for part in parts:
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return os.path.join(self.directory, f'{kind}-{h.hexdigest()}')
+
+    def _stat_entry(self, inputs: list[str], fs: FileSystem) -> str | None:
+        parts: list[bytes] = []
+        for path in inputs:
+            st = fs.stat(path)
+            if st is None:
+                return None
+            stat_s = f'{st.st_mtime_ns} {st.st_size} {st.st_ino}'
+            parts.extend((os.path.abspath(path).encode(), stat_s.encode()))
+        return self._entry('stat', parts)
+
+    def _content_entry(self, inputs: list[str], fs: FileSystem) -> str:
+        parts: list[bytes] = []
+        for path in inputs:
+            contents = fs.read_bytes(path)
+            parts.extend((os.path.basename(path).encode(), contents))
+        return self._entry('content', parts)
+
+    def _hit(self, entry: str) -> bool:
+        try:
+            os.utime(entry)  # mark as recently used
+        except FileNotFoundError:
+            return False
+        else:
+            return True
+
+    def _mark(self, entry: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        open(entry, 'wb').close()
+
+    def is_formatted(self, filename: str, project: Project) -> bool:
+        inputs = self._inputs(filename, project)
+        stat_entry = self._stat_entry(inputs, project.fs)
+        if stat_entry is not None and self._hit(stat_entry):
+            return True
+
+        content_entry = self._content_entry(inputs, project.fs)
+        if self._hit(content_entry):
+            if stat_entry is not None:
+                self._mark(stat_entry)
+            return True
+        else:
+            self._missed[filename] = (stat_entry, content_entry)
+            return False
+
+    def mark_formatted(
+            self,
+            filename: str,
+            project: Project,
+            *,
+            rewritten: bool,
+    ) -> None:
+        entries = self._missed.pop(filename, None)
+        if entries is None or rewritten:
+            inputs = self._inputs(filename, project)
+            content_entry = self._content_entry(inputs, project.fs)
+            stat_entry = self._stat_entry(inputs, project.fs)
+        else:
+            stat_entry, content_entry = entries
+        self._mark(content_entry)
+        if stat_entry is not None:
+            self._mark(stat_entry)
+
+    def prune(self) -> None:
+        """Evict the least recently used entries."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+
+        if len(entries) > self.MAX_ENTRIES:
+            entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in entries[:len(entries) - self.MAX_ENTRIES]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+
+
+def _diff(filename: str, contents: str, new_contents: str) -> str:
+    import difflib
+
+    return ''.join(
+        difflib.unified_diff(
+            contents.splitlines(keepends=True),
+            new_contents.splitlines(keepends=True),
+            fromfile=filename,
+            tofile=filename,
+        ),
+    )
+
+
+def _process_file(
+        filename: str, *,
+        cache: _ResultCache | None,
+        write: bool,
+        fsync: bool,
+        diff: bool,
+        record: bool,
+        check_classifiers: bool,
+        include_version_classifiers: bool,
+        min_py_version: tuple[int, int] | None,
+        max_py_version: tuple[int, int],
+        license_db: str | None,
+) -> tuple[bool, str, list[Span], list[str]]:
+    """Returns whether the file needs changes, the diff (if requested), the
+    timed phases (if recording) and the unknown classifiers (if checking)."""
+    unknown: list[str] = []
+    with _recording(filename, record) as spans:
+        with _phase('project'):
+            project = Project(filename)
+
+        if cache is not None:
+            with _phase('cache'):
+                if cache.is_formatted(filename, project):
+                    return False, '', spans, unknown
+
+        with _phase('read'):
+            contents = project.fs.read_text(filename)
+
+        new_contents = format_string(
+            contents,
+            context=project,
+            include_version_classifiers=include_version_classifiers,
+            min_py_version=min_py_version,
+            max_py_version=max_py_version,
+            license_db=license_db,
+            on_unknown_classifier=(
+                unknown.append if check_classifiers else None
+            ),
+        )
+        changed = new_contents != contents
+
+        if changed and write:
+            with _phase('write'):
+                project.fs.write_text(filename, new_contents, fsync=fsync)
+
+        # not remembered as formatted so the problems are reported again
+        if cache is not None and (write or not changed) and not unknown:
+            with _phase('cache'):
+                cache.mark_formatted(
+                    filename, project, rewritten=changed and write,
+                )
+
+        if changed and diff:
+            output = _diff(filename, contents, new_contents)
+        else:
+            output = ''
+
+    return changed, output, spans, unknown
+
+
+def _imap(
+        func: Callable[[T], R],
+        items: Iterable[T],
+        *,
+        jobs: int,
+        ordered: bool,
+) -> Generator[R]:
+    """`map` over a process pool with at most `2 * jobs` items in flight"""
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    import concurrent.futures
+
+    max_in_flight = 2 * jobs
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    try:
+        if ordered:
+            queue: collections.deque[concurrent.futures.Future[R]]
+            queue = collections.deque()
+            for item in items:
+                queue.append(executor.submit(func, item))
+                if len(queue) >= max_in_flight:
+                    yield queue.popleft().result()
+            while queue:
+                yield queue.popleft().result()
+        else:
+            pending: set[concurrent.futures.Future[R]] = set()
+            for item in items:
+                pending.add(executor.submit(func, item))
+                if len(pending) >= max_in_flight:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class Document(NamedTuple):
+    """an in-memory setup.cfg to format with `format_many`"""
+    name: str
+    contents: str
+    context: Project | None = None
+
+
+class FormatResult(NamedTuple):
+    """the outcome of formatting one file with `format_many`"""
+    name: str
+    changed: bool
+    contents: str | None  # the formatted contents
+    diff: str
+    spans: list[Span]
+    error: Exception | None
+
+
+def _format_one(
+        item: str | Document,
+        *,
+        write: bool,
+        diff: bool,
+        include_version_classifiers: bool,
+        min_py_version: tuple[int, int] | None,
+        max_py_version: tuple[int, int],
+        license_db: str | None,
+) -> FormatResult:
+    fmt = functools.partial(
+        format_string,
+        include_version_classifiers=include_version_classifiers,
+        min_py_version=min_py_version,
+        max_py_version=max_py_version,
+        license_db=license_db,
+    )
+
+    name = item.name if isinstance(item, Document) else item
+    with _recording(name, True) as spans:
+        try:
+            if isinstance(item, Document):
+                contents = item.contents
+                new_contents = fmt(contents, context=item.context)
+            else:
+                project = Project(name)
+                with _phase('read'):
+                    contents = project.fs.read_text(name)
+                new_contents = fmt(contents, context=project)
+                if write and new_contents != contents:
+                    with _phase('write'):
+                        project.fs.write_text(name, new_contents)
+        except Exception as e:
+            return FormatResult(name, False, None, '', spans, e)
+
+    changed = new_contents != contents
+    if changed and diff:
+        diff_s = _diff(name, contents, new_contents)
+    else:
+        diff_s = ''
+    return FormatResult(name, changed, new_contents, diff_s, spans, None)
+
+
+def format_many(
+        items: Iterable[str | Document],
+        *,
+        jobs: int = 1,
+        write: bool = False,
+        diff: bool = False,
+        include_version_classifiers: bool,
+        min_py_version: tuple[int, int] | None,
+        max_py_version: tuple[int, int],
+        license_db: str | None = None,
+) -> Generator[FormatResult]:
+    """Format setup.cfg files (or in-memory `Document`s).
+
+    Results are yielded as they complete and at most `2 * jobs` files are
+    in flight, so `items` may be a (lazy) iterable of any size.  With
+    `write`, changed files are rewritten (`Document`s never are).  An error
+    formatting one file is reported in its result rather than raised.
+    """
+    func = functools.partial(
+        _format_one,
+        write=write,
+        diff=diff,
+        include_version_classifiers=include_version_classifiers,
+        min_py_version=min_py_version,
+        max_py_version=max_py_version,
+        license_db=license_db,
+    )
+    jobs = jobs or os.cpu_count() or 1
+    results = _imap(func, items, jobs=jobs, ordered=False)
+    with contextlib.closing(results):
+        for result in results:
+            _emit_spans(result.spans)
+            yield result
+
+
+def _percentile(values: list[float], p: float) -> float:
+    """nearest-rank percentile of sorted `values`"""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def _profile_report(spans: list[Span]) -> dict[str, dict[str, float]]:
+    by_phase: dict[str, list[float]] = collections.defaultdict(list)
+    for span in spans:
+        if span.name != FILE_SPAN:
+            by_phase[span.name].append(span.duration)
+
+    report = {}
+    for phase, values in by_phase.items():
+        values.sort()
+        report[phase] = {
+            'count': len(values),
+            'total': sum(values),
+            'p50': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'p99': _percentile(values, 99),
+            'max': values[-1],
+        }
+    return report
+
+
+def _print_profile_report(report: dict[str, dict[str, float]]) -> None:
+    grand_total = sum(stats['total'] for stats in report.values()) or 1
+
+    def _ms(seconds: float) -> str:
+        return f'{seconds * 1000:.3f}ms'
+
+    print(
+        f'{"phase":<16}{"count":>7}{"total":>13}{"%":>7}'
+        f'{"p50":>11}{"p90":>11}{"p99":>11}{"max":>11}',
+        file=sys.stderr,
+    )
+    for phase, stats in sorted(report.items(), key=lambda kv: -kv[1]['total']):
+        print(
+            f'{phase:<16}{stats["count"]:>7}{_ms(stats["total"]):>13}'
+            f'{stats["total"] / grand_total:>7.1%}'
+            f'{_ms(stats["p50"]):>11}{_ms(stats["p90"]):>11}'
+            f'{_ms(stats["p99"]):>11}{_ms(stats["max"]):>11}',
+            file=sys.stderr,
+        )
+
+
+def _trace_events(spans: list[Span]) -> dict[str, Any]:
+    events = [
+        {
+            'name': span.name,
+            'cat': 'file' if span.name == FILE_SPAN else 'phase',
+            'ph': 'X',
+            'ts': span.start * 1e6,
+            'dur': span.duration * 1e6,
+            'pid': span.pid,
+            'tid': span.tid,
+            'args': {'filename': span.filename},
+        }
+        for span in sorted(spans, key=lambda span: span.start)
+    ]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+WALK_SKIP = frozenset((
+    '.git', '.hg', '.nox', '.tox', '.venv', '__pycache__', 'node_modules',
+    'venv',
+))
+
+
+def _walk(top: str, exclude: re.Pattern[str] | None) -> Generator[str]:
+    """Yields the setup.cfg files in `top`, pruning skipped directories."""
+    stack = [top]
+    while stack:
+        dirname = stack.pop()
+        try:
+            with os.scandir(dirname) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            if entry.name in WALK_SKIP:
+                continue
+            elif exclude is not None and (
+                    exclude.match(entry.name) or exclude.match(entry.path)
+            ):
+                continue
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name == 'setup.cfg' and entry.is_file():
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def _find_files(paths: list[str], *, exclude: list[str]) -> Generator[str]:
+    if exclude:
+        import fnmatch
+
+        patterns = (fnmatch.translate(pattern) for pattern in exclude)
+        exclude_re = re.compile('|'.join(patterns))
+    else:
+        exclude_re = None
+
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _walk(path, exclude_re)
+        else:
+            yield path
+
+
+def _git(*cmd: str, cwd: str | None = None) -> str | None:
+    import subprocess
+
+    proc = subprocess.run(
+        ('git', *cmd), cwd=cwd, capture_output=True, text=True,
+    )
+    if proc.returncode:
+        print(proc.stderr, end='', file=sys.stderr)
+        return None
+    else:
+        return proc.stdout
+
+
+def _is_input(name: str) -> bool:
+    """whether `name` can affect the formatting of an adjacent setup.cfg"""
+    return (
+        name in {'setup.cfg', 'tox.ini'} or
+        name.lower().startswith(('readme', 'license', 'licence'))
+    )
+
+
+def _changed_dirs(ref: str) -> set[str] | None:
+    """The directories where inputs changed since `ref` (None on error)."""
+    top = _git('rev-parse', '--show-toplevel')
+    if top is None:
+        return None
+    top = top.rstrip('\n')
+
+    diff = ('diff', '--name-only', '--no-renames', '-z', ref)
+    untracked = ('ls-files', '--others', '--exclude-standard', '-z')
+    paths = []
+    for cmd in (diff, untracked):
+        out = _git(*cmd, cwd=top)
+        if out is None:
+            return None
+        paths.extend(out.split('\0')[:-1])
+
+    return {
+        os.path.normpath(os.path.join(top, os.path.dirname(path)))
+        for path in paths
+        if _is_input(os.path.basename(path))
+    }
+
+
+def _report_unknown_classifiers(filename: str, unknown: list[str]) -> None:
+    if not unknown:  # avoid importing trove_classifiers in the common case
+        return
+
+    import trove_classifiers
+
+    for classifier in unknown:
+        replacements = trove_classifiers.deprecated_classifiers.get(classifier)
+        if replacements is None:
+            msg = f'unknown classifier: {classifier}'
+        elif replacements:
+            msg = (
+                f'deprecated classifier: {classifier} '
+                f'(use: {", ".join(replacements)})'
+            )
+        else:
+            msg = f'deprecated classifier: {classifier}'
+        print(f'{filename}: {msg}', file=sys.stderr)
+
+
 def _ver_type(s: str) -> Version:
+    import argparse
+
     try:
         version = _to_ver(s)
     except UnknownVersionError:
@@ -481,26 +1783,586 @@ def _ver_type(s: str) -> Version:
         return version
 
 
-def main(argv: Sequence[str] | None = None) -> int:
+def _jobs_type(s: str) -> int:
+    import argparse
+
+    try:
+        jobs = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected integer, got {s!r}')
+
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f'must be at least 0, got {s!r}')
+    else:
+        return jobs
+
+
+def _parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    import argparse
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('filenames', nargs='*')
+    parser.add_argument(
+        'filenames', nargs='*',
+        help=(
+            'setup.cfg files or directories to search for them, '
+            'use `-` to format stdin and write the result to stdout'
+        ),
+    )
+    parser.add_argument(
+        '--exclude', metavar='PATTERN', action='append', default=[],
+        help=(
+            'skip files and directories matching this glob when searching '
+            'directories (may be specified multiple times)'
+        ),
+    )
     parser.add_argument('--include-version-classifiers', action='store_true')
     parser.add_argument('--min-py-version', type=_ver_type)
     parser.add_argument('--max-py-version', type=_ver_type, default=(3, 14))
+    parser.add_argument(
+        '--unknown-classifiers', choices=('ignore', 'warn', 'error'),
+        default='ignore',
+        help=(
+            'report classifiers which are not known trove classifiers, '
+            '`error` also exits nonzero (default: %(default)s)'
+        ),
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=_jobs_type, default=1,
+        help='number of files to format in parallel (0: number of cpus)',
+    )
+    parser.add_argument(
+        '--cache', action='store_true',
+        help=(
+            'skip files which are known to be formatted already '
+            '(stored in $XDG_CACHE_HOME/setup-cfg-fmt)'
+        ),
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--check', action='store_true',
+        help='do not write files, only report which would be rewritten',
+    )
+    mode.add_argument(
+        '--diff', action='store_true',
+        help='do not write files, print a diff of the changes instead',
+    )
+    parser.add_argument(
+        '--fsync', choices=('never', 'file', 'batch'), default='never',
+        help=(
+            'when to flush rewritten files to disk: `file` after each one, '
+            '`batch` once all files are written (default: %(default)s)'
+        ),
+    )
+    parser.add_argument(
+        '--changed-since', metavar='REF',
+        help=(
+            'only format setup.cfg files where it or its README / LICENSE / '
+            'tox.ini changed since the git REF (or is untracked)'
+        ),
+    )
+    parser.add_argument(
+        '--fail-fast', action='store_true',
+        help=(
+            'stop after the first file which needs changes '
+            '(with --check or --diff)'
+        ),
+    )
+    parser.add_argument(
+        '--stdin-filename', default='setup.cfg',
+        help=(
+            'path used to find the README / LICENSE / tox.ini when '
+            'formatting stdin (default: %(default)s)'
+        ),
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help=(
+            'serve formatting requests on a unix socket, later invocations '
+            'are forwarded to it instead of formatting in-process'
+        ),
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='print the time spent in each phase of formatting to stderr',
+    )
+    parser.add_argument(
+        '--profile-json', metavar='FILENAME',
+        help='write the --profile report as json to FILENAME',
+    )
+    parser.add_argument(
+        '--trace', metavar='FILENAME',
+        help='write a timeline of each file and phase to FILENAME (in the '
+        'chrome trace event format)',
+    )
+    parser.add_argument(
+        '--lsp', action='store_true',
+        help='run a language server (over stdio) providing formatting',
+    )
     args = parser.parse_args(argv)
 
+    if '-' in args.filenames and len(args.filenames) > 1:
+        parser.error('`-` cannot be combined with other filenames')
+    # files already in flight would be rewritten without being reported
+    if args.fail_fast and not args.check and not args.diff:
+        parser.error('--fail-fast requires --check or --diff')
+    if args.daemon and sys.platform == 'win32':  # pragma: win32 cover
+        parser.error('--daemon is not supported on windows')
+
+    return args
+
+
+def _run(args: argparse.Namespace) -> int:
+    if args.cache:
+        options = (
+            args.include_version_classifiers,
+            args.min_py_version,
+            args.max_py_version,
+            args.unknown_classifiers,
+        )
+        cache = _ResultCache(os.path.join(_cache_dir(), 'results'), options)
+        license_db = os.path.join(_cache_dir(), 'licenses.db')
+    else:
+        cache = None
+        license_db = None
+
+    check_classifiers = args.unknown_classifiers != 'ignore'
+    fail_unknown = args.unknown_classifiers == 'error'
+
+    if args.filenames == ['-']:
+        contents = sys.stdin.read()
+        try:
+            context = Project(args.stdin_filename)
+        except FileNotFoundError:  # such as an unsaved editor buffer
+            context = Project.from_files({})
+        unknown: list[str] = []
+        new_contents = format_string(
+            contents,
+            context=context,
+            include_version_classifiers=args.include_version_classifiers,
+            min_py_version=args.min_py_version,
+            max_py_version=args.max_py_version,
+            license_db=license_db,
+            on_unknown_classifier=(
+                unknown.append if check_classifiers else None
+            ),
+        )
+        _report_unknown_classifiers(args.stdin_filename, unknown)
+        failed = fail_unknown and bool(unknown)
+        if args.diff:
+            print(_diff(args.stdin_filename, contents, new_contents), end='')
+        elif args.check:
+            if new_contents != contents:
+                print(f'Would rewrite {args.stdin_filename}')
+        else:
+            sys.stdout.write(new_contents)
+            return int(failed)
+        return int(failed or new_contents != contents)
+
+    write = not args.check and not args.diff
+    func = functools.partial(
+        _process_file,
+        cache=cache,
+        write=write,
+        fsync=args.fsync == 'file',
+        diff=args.diff,
+        record=(
+            args.profile or
+            args.profile_json is not None or
+            args.trace is not None or
+            bool(_span_hooks)
+        ),
+        check_classifiers=check_classifiers,
+        include_version_classifiers=args.include_version_classifiers,
+        min_py_version=args.min_py_version,
+        max_py_version=args.max_py_version,
+        license_db=license_db,
+    )
+
+    filenames: Iterator[str]
+    filenames = _find_files(args.filenames, exclude=args.exclude)
+    if args.changed_since is not None:
+        changed_dirs = _changed_dirs(args.changed_since)
+        if changed_dirs is None:
+            return 1
+        filenames = (
+            filename for filename in filenames
+            if os.path.dirname(os.path.realpath(filename)) in changed_dirs
+        )
+    head = list(itertools.islice(filenames, 3))
+    filenames = itertools.chain(head, filenames)
+
+    jobs = args.jobs or os.cpu_count() or 1
+    # a process pool isn't worth the startup cost for a couple of files
+    if len(head) <= 2:
+        jobs = 1
+
     retv = 0
-    for filename in args.filenames:
-        if format_file(
-                filename,
-                include_version_classifiers=args.include_version_classifiers,
-                min_py_version=args.min_py_version,
-                max_py_version=args.max_py_version,
-        ):
-            print(f'Rewriting {filename}')
+    spans = []
+    rewritten = []
+    # the names are buffered only while their files are in flight
+    filenames, names = itertools.tee(filenames)
+    results = _imap(func, filenames, jobs=jobs, ordered=True)
+    with contextlib.closing(results):
+        for filename, result in zip(names, results):
+            changed, output, file_spans, unknown = result
+            _emit_spans(file_spans)
+            spans.extend(file_spans)
+            _report_unknown_classifiers(filename, unknown)
+            if fail_unknown and unknown:
+                retv = 1
+            if not changed:
+                continue
+
             retv = 1
+            if args.diff:
+                print(output, end='')
+            elif args.check:
+                print(f'Would rewrite {filename}')
+            else:
+                print(f'Rewriting {filename}')
+                rewritten.append(filename)
+
+            if args.fail_fast:  # closing `results` cancels the rest
+                break
+
+    if args.fsync == 'batch':
+        _fsync_files(rewritten)
+
+    if cache is not None:
+        cache.prune()
+
+    if args.profile or args.profile_json is not None:
+        report = _profile_report(spans)
+        if args.profile:
+            _print_profile_report(report)
+        if args.profile_json is not None:
+            import json
+
+            with open(args.profile_json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.trace is not None:
+        import json
+
+        with open(args.trace, 'w') as f:
+            json.dump(_trace_events(spans), f)
+
     return retv
 
 
+# how long to wait for a daemon to accept a request before formatting
+# in-process instead (for example when it was stopped)
+DAEMON_TIMEOUT = 1
+
+
+def _daemon_socket() -> str:
+    # in a private directory so the socket is never accessible to others
+    return os.path.join(_cache_dir(), 'daemon', 'daemon.sock')
+
+
+def _daemon_token() -> str:
+    """Identifies the code a daemon is running, to detect stale daemons."""
+    import importlib.util
+
+    # the license and classifier data change when these are upgraded
+    specs = [
+        importlib.util.find_spec(name)
+        for name in ('identify', 'trove_classifiers')
+    ]
+    paths = [__file__]
+    paths.extend(spec.origin for spec in specs if spec and spec.origin)
+    return ' '.join(f'{path}:{os.stat(path).st_mtime_ns}' for path in paths)
+
+
+def _daemon_server(path: str) -> socketserver.UnixStreamServer:
+    import json
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            request = json.loads(self.rfile.readline())
+            stale = request['token'] != _daemon_token()
+            # acknowledge the request before doing the work
+            self.wfile.write(f'{json.dumps({"stale": stale})}\n'.encode())
+            self.wfile.flush()
+            if not stale:
+                response = _daemon_run(request['argv'], request['cwd'])
+                self.wfile.write(json.dumps(response).encode())
+
+    # `_daemon_run` changes the working directory and redirects output, so
+    # concurrent requests (such as pre-commit's parallel runs) each get a
+    # process of their own
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        pass
+
+    return Server(path, Handler)
+
+
+def _daemon_run(argv: list[str], cwd: str) -> dict[str, object]:
+    out = io.StringIO()
+    err = io.StringIO()
+    orig_cwd = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            retv = _run(_parse_args(argv))
+    except SystemExit as e:  # argparse errors
+        retv = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        import traceback
+
+        traceback.print_exc(file=err)
+        retv = 1
+    finally:
+        os.chdir(orig_cwd)
+
+    return {
+        'stale': False,
+        'retv': retv,
+        'out': out.getvalue(),
+        'err': err.getvalue(),
+    }
+
+
+def _daemon_warm() -> None:
+    """Import and compute in the parent what every forked request needs."""
+    import argparse  # noqa: F401
+    import concurrent.futures  # noqa: F401
+    import json  # noqa: F401
+
+    import identify.identify  # noqa: F401
+    import identify.vendor.licenses  # noqa: F401
+    import trove_classifiers  # noqa: F401
+
+    _normed_licenses()
+    _exact_license_ids()
+    _license_shingles()
+
+
+def _serve_daemon(path: str) -> int:
+    if _daemon_request(path, []) is not None:
+        print(f'daemon is already running: {path}', file=sys.stderr)
+        return 1
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(path), 0o700)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)  # left behind by a daemon which was killed
+
+    _daemon_warm()
+    with _daemon_server(path) as server:
+        print(f'listening on {path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+    return 0
+
+
+def _daemon_request(path: str, argv: list[str]) -> dict[str, Any] | None:
+    """Returns the daemon's response, or None if no daemon is usable."""
+    if not os.path.exists(path):  # avoid importing socket in the common case
+        return None
+
+    import json
+    import socket
+
+    request = {'token': _daemon_token(), 'argv': argv, 'cwd': os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(f'{json.dumps(request)}\n'.encode())
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile('rb') as f:
+                if json.loads(f.readline())['stale']:
+                    return None
+                # accepted: formatting takes as long as it takes
+                sock.settimeout(None)
+                return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _lsp_read(f: IO[bytes]) -> Any:
+    import json
+
+    headers = {}
+    while True:
+        line = f.readline()
+        if not line:
+            return None
+        elif not line.strip():
+            break
+        k, _, v = line.decode().partition(':')
+        headers[k.strip().lower()] = v.strip()
+
+    return json.loads(f.read(int(headers['content-length'])))
+
+
+def _lsp_write(f: IO[bytes], msg: dict[str, object]) -> None:
+    import json
+
+    body = json.dumps({'jsonrpc': '2.0', **msg}).encode()
+    f.write(f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    f.flush()
+
+
+def _text_edits(contents: str, new_contents: str) -> list[dict[str, Any]]:
+    """Produce LSP `TextEdit`s covering only the changed lines."""
+    import difflib
+
+    # unlike `str.splitlines`, only splits on the line endings LSP counts
+    lines = io.StringIO(contents, newline='').readlines()
+    new_lines = io.StringIO(new_contents, newline='').readlines()
+
+    def _position(i: int) -> dict[str, int]:
+        # past the end of a last line without a line break: its end instead
+        if i == len(lines) and lines and not lines[-1].endswith(('\n', '\r')):
+            # LSP counts characters in UTF-16 code units
+            character = len(lines[-1].encode('UTF-16-LE')) // 2
+            return {'line': i - 1, 'character': character}
+        else:
+            return {'line': i, 'character': 0}
+
+    edits: list[dict[str, Any]] = []
+    matcher = difflib.SequenceMatcher(None, lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            edits.append({
+                'range': {'start': _position(i1), 'end': _position(i2)},
+                'newText': ''.join(new_lines[j1:j2]),
+            })
+    return edits
+
+
+def _uri_to_path(uri: str) -> str:
+    import urllib.parse
+    import urllib.request
+
+    return urllib.request.url2pathname(urllib.parse.urlparse(uri).path)
+
+
+def _lsp_serve(
+        stdin: IO[bytes],
+        stdout: IO[bytes],
+        args: argparse.Namespace,
+) -> int:
+    if args.cache:
+        license_db: str | None = os.path.join(_cache_dir(), 'licenses.db')
+    else:
+        license_db = None
+
+    documents: dict[str, str] = {}
+    shutdown = False
+
+    while True:
+        msg = _lsp_read(stdin)
+        if msg is None:
+            return 1
+
+        method = msg.get('method')
+        params = msg.get('params', {})
+
+        if method == 'initialize':
+            result: object = {
+                'capabilities': {
+                    'textDocumentSync': 1,  # full
+                    'documentFormattingProvider': True,
+                },
+                'serverInfo': {'name': 'setup-cfg-fmt'},
+            }
+        elif method == 'textDocument/didOpen':
+            doc = params['textDocument']
+            documents[doc['uri']] = doc['text']
+            continue
+        elif method == 'textDocument/didChange':
+            uri = params['textDocument']['uri']
+            documents[uri] = params['contentChanges'][-1]['text']
+            continue
+        elif method == 'textDocument/didClose':
+            documents.pop(params['textDocument']['uri'], None)
+            continue
+        elif method == 'textDocument/formatting':
+            uri = params['textDocument']['uri']
+            path = _uri_to_path(uri)
+            try:
+                contents = documents[uri]
+            except KeyError:
+                with open(path) as f:
+                    contents = f.read()
+
+            try:
+                new_contents = format_string(
+                    contents,
+                    context=Project(path),
+                    include_version_classifiers=(
+                        args.include_version_classifiers
+                    ),
+                    min_py_version=args.min_py_version,
+                    max_py_version=args.max_py_version,
+                    license_db=license_db,
+                )
+            except Exception as e:
+                _lsp_write(
+                    stdout, {
+                        'id': msg['id'],
+                        'error': {
+                            'code': -32603,  # InternalError
+                            'message': f'{type(e).__name__}: {e}',
+                        },
+                    },
+                )
+                continue
+
+            result = _text_edits(contents, new_contents)
+        elif method == 'shutdown':
+            shutdown = True
+            result = None
+        elif method == 'exit':
+            return 0 if shutdown else 1
+        elif 'id' not in msg:  # other notifications are not interesting
+            continue
+        else:
+            _lsp_write(
+                stdout, {
+                    'id': msg['id'],
+                    'error': {
+                        'code': -32601,  # MethodNotFound
+                        'message': f'unknown method: {method}',
+                    },
+                },
+            )
+            continue
+
+        _lsp_write(stdout, {'id': msg['id'], 'result': result})
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    args = _parse_args(argv)
+
+    if args.daemon:
+        return _serve_daemon(_daemon_socket())
+    elif args.lsp:
+        return _lsp_serve(sys.stdin.buffer, sys.stdout.buffer, args)
+
+    if (
+            args.filenames and args.filenames != ['-'] and
+            # windows does not have unix sockets
+            sys.platform != 'win32'
+    ):
+        response = _daemon_request(_daemon_socket(), argv)
+        if response is not None:
+            sys.stdout.write(response['out'])
+            sys.stderr.write(response['err'])
+            return response['retv']
+
+    return _run(args)
+
+
 if __name__ == '__main__':
     raise SystemExit(main())
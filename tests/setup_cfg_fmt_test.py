@@ -1,15 +1,51 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import configparser
+import contextlib
+import functools
+import io
+import json
 import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import mock
 
 import pytest
+from identify import identify
+from identify.vendor import licenses
 
-from setup_cfg_fmt import _case_insensitive_glob
+import setup_cfg_fmt
+from setup_cfg_fmt import _cache_dir
+from setup_cfg_fmt import _fuzzy_license_id
+from setup_cfg_fmt import _jobs_type
 from setup_cfg_fmt import _natural_sort
-from setup_cfg_fmt import _normalize_lib
+from setup_cfg_fmt import _parse_requirement
+from setup_cfg_fmt import _ResultCache
 from setup_cfg_fmt import _ver_type
+from setup_cfg_fmt import add_span_hook
+from setup_cfg_fmt import Document
+from setup_cfg_fmt import FileSystem
+from setup_cfg_fmt import format_file
+from setup_cfg_fmt import format_many
+from setup_cfg_fmt import format_string
+from setup_cfg_fmt import LICENSE_MAX_SIZE
 from setup_cfg_fmt import main
+from setup_cfg_fmt import MemoryFileSystem
+from setup_cfg_fmt import Project
+from setup_cfg_fmt import remove_span_hook
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    cache_home = tmp_path.joinpath('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_home))
+    return cache_home
 
 
 def test_ver_type_ok():
@@ -31,18 +67,6 @@ def test_ver_type_error(s, expected):
     assert msg == expected
 
 
-@pytest.mark.parametrize(
-    ('s', 'expected'),
-    (
-        ('foo', '[Ff][Oo][Oo]'),
-        ('FOO', '[Ff][Oo][Oo]'),
-        ('licen[sc]e', '[Ll][Ii][Cc][Ee][Nn][SsCc][Ee]'),
-    ),
-)
-def test_case_insensitive_glob(s, expected):
-    assert _case_insensitive_glob(s) == expected
-
-
 def test_noop(tmpdir):
     setup_cfg = tmpdir.join('setup.cfg')
     setup_cfg.write(
@@ -275,10 +299,38 @@ def test_rewrite(input_s, expected, tmpdir):
         pytest.param('req13 !=2, >= 7', 'req13!=2,>=7', id='>= cond at end'),
         pytest.param('req14 <=2, >= 1', 'req14>=1,<=2', id='b/w conds sorted'),
         pytest.param('req15~=2', 'req15~=2', id='compatible release'),
+        pytest.param('req >=1, ~=1.2', 'req~=1.2,>=1', id='lower bounds'),
+        pytest.param('req_a.b>=1', 'req-a.b>=1', id='underscores in name'),
+        pytest.param('req [a_b, c]>=1', 'req[a-b,c]>=1', id='extras'),
+        pytest.param('req (>=1, <2)', 'req>=1,<2', id='parenthesized'),
+        pytest.param('req>=1,', 'req>=1', id='trailing comma'),
+        pytest.param(
+            'req >= 1 ; python_version < "3.12"',
+            'req>=1;python_version < "3.12"',
+            id='marker',
+        ),
+        pytest.param('req;', 'req', id='empty marker'),
+        pytest.param(
+            'req [a] @ https://example.com/a,b.zip',
+            'req[a]@https://example.com/a,b.zip',
+            id='url',
+        ),
+        pytest.param(
+            'req @ https://example.com/req.zip ; os_name == "nt"',
+            'req@https://example.com/req.zip ;os_name == "nt"',
+            id='url and marker keep their whitespace',
+        ),
+        pytest.param('req @ ', 'req @ ', id='invalid: empty url'),
+        pytest.param('req~1', 'req~1', id='invalid: operator'),
+        pytest.param('req>=', 'req>=', id='invalid: empty version'),
+        pytest.param('req>=1 <2', 'req>=1 <2', id='invalid: missing comma'),
+        pytest.param('req (>=1', 'req (>=1', id='invalid: unclosed paren'),
+        pytest.param('req[a', 'req[a', id='invalid: unclosed extras'),
+        pytest.param('@ url', '@ url', id='invalid: no name'),
     ),
 )
-def test_normalize_lib(lib, expected):
-    assert _normalize_lib(lib) == expected
+def test_parse_requirement(lib, expected):
+    assert _parse_requirement(lib).text == expected
 
 
 @pytest.mark.parametrize(
@@ -914,6 +966,62 @@ def test_python_requires_with_patch_version(tmpdir):
     )
 
 
+def test_uncommon_python_version_classifiers():
+    ret = format_string(
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: 2.7\n'
+        '    Programming Language :: Python :: 3.11\n'
+        '    Programming Language :: Python :: 3.11.4\n'
+        '    Programming Language :: Python :: 3.12.1\n'
+        '    Programming Language :: Python :: 3.99\n'
+        '    Programming Language :: Python :: 4\n'
+        '    Programming Language :: Python :: Implementation\n'
+        '\n'
+        '[options]\n'
+        'python_requires = >=3.11, !=3.12.1\n',
+        include_version_classifiers=True,
+        min_py_version=None,
+        max_py_version=(3, 12),
+    )
+
+    assert ret == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: 3\n'
+        '    Programming Language :: Python :: 3 :: Only\n'
+        '    Programming Language :: Python :: 3.11\n'
+        '    Programming Language :: Python :: 3.11.4\n'
+        '    Programming Language :: Python :: 3.12\n'
+        '    Programming Language :: Python :: 4\n'
+        '    Programming Language :: Python :: Implementation\n'
+        '\n'
+        '[options]\n'
+        'python_requires = >=3.11, !=3.12.1.*\n'
+    )
+
+
+def test_python_requires_beyond_max_py_version():
+    ret = format_string(
+        '[metadata]\nname = pkg\n\n[options]\npython_requires = >=4.0\n',
+        include_version_classifiers=True,
+        min_py_version=None,
+        max_py_version=(3, 12),
+    )
+
+    assert ret == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: 3 :: Only\n'
+        '\n'
+        '[options]\n'
+        'python_requires = >=4.0\n'
+    )
+
+
 def test_classifiers_left_alone_for_odd_python_requires(tmpdir):
     setup_cfg = tmpdir.join('setup.cfg')
     setup_cfg.write(
@@ -1195,3 +1303,1812 @@ def test_natural_sort():
         'Programming Language :: Python :: 3.9',
         'Programming Language :: Python :: 3.10',
     ]
+
+
+@pytest.mark.parametrize(
+    ('s', 'expected'),
+    (
+        ('', ('',)),
+        ('Topic :: Utilities', ('topic :: utilities',)),
+        ('Python :: 3.10', ('python :: ', 3, '.', 10, '')),
+        ('3 :: Only', ('', 3, ' :: only')),
+        ('a\u0663b', ('a', 3, 'b')),  # non-ascii decimal digits
+        ('a\u00b2', ('a\u00b2',)),  # but not other digits
+    ),
+)
+def test_natural_key(s, expected):
+    assert setup_cfg_fmt._natural_key(s) == expected
+
+
+def test_format_string_unknown_classifiers():
+    src = (
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Topic :: Utilities\n'
+        '    Topic :: Utilites\n'
+        '    Private :: Do Not Upload\n'
+        '    License :: Made Up\n'
+        '    Natural Language :: Ukranian\n'
+    )
+    unknown: list[str] = []
+    format_string(
+        src,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+        on_unknown_classifier=unknown.append,
+    )
+    assert unknown == [
+        'Natural Language :: Ukranian',
+        'Topic :: Utilites',
+    ]
+
+
+@pytest.mark.parametrize(
+    ('option', 'expected_retv', 'expected_err'),
+    (
+        ('ignore', 0, ''),
+        (
+            'warn', 0,
+            '{}: deprecated classifier: Framework :: Django CMS :: 4.2 '
+            '(use: Framework :: Django CMS :: 5.0)\n'
+            '{}: deprecated classifier: Topic :: Communications :: Chat :: '
+            'AOL Instant Messenger\n'
+            '{}: unknown classifier: Topic :: Utilites\n',
+        ),
+        (
+            'error', 1,
+            '{}: deprecated classifier: Framework :: Django CMS :: 4.2 '
+            '(use: Framework :: Django CMS :: 5.0)\n'
+            '{}: deprecated classifier: Topic :: Communications :: Chat :: '
+            'AOL Instant Messenger\n'
+            '{}: unknown classifier: Topic :: Utilites\n',
+        ),
+    ),
+)
+def test_main_unknown_classifiers(
+        option, expected_retv, expected_err, tmp_path, capsys,
+):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text(
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Framework :: Django CMS :: 4.2\n'
+        '    Topic :: Communications :: Chat :: AOL Instant Messenger\n'
+        '    Topic :: Utilites\n',
+    )
+
+    args = (f'--unknown-classifiers={option}', str(setup_cfg))
+    assert main(args) == expected_retv
+
+    _, err = capsys.readouterr()
+    assert err == expected_err.format(*(setup_cfg,) * 3)
+
+
+def test_unknown_classifiers_not_cached(cache_home, tmp_path, capsys):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text(
+        '[metadata]\n'
+        'name = pkg\n'
+        'classifiers =\n'
+        '    Topic :: Utilites\n',
+    )
+
+    args = ('--cache', '--unknown-classifiers=error', str(setup_cfg))
+    assert main(args)
+    assert main(args)
+
+    _, err = capsys.readouterr()
+    assert err == f'{setup_cfg}: unknown classifier: Topic :: Utilites\n' * 2
+
+
+@pytest.mark.parametrize('mode', ((), ('--check',)))
+def test_stdin_unknown_classifiers(mode, tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    contents = '[metadata]\nname = pkg\nclassifiers =\n    Topic :: Utilites\n'
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(contents))
+
+    assert main(('-', '--unknown-classifiers=error', *mode))
+
+    out, err = capsys.readouterr()
+    assert out == ('' if mode else contents)
+    assert err == 'setup.cfg: unknown classifier: Topic :: Utilites\n'
+
+
+def _setup_cfgs(tmp_path, *dirnames, n=0, formatted=False, license=None):
+    """Write a setup.cfg to each of `dirnames` (default: `n` of `p#`).
+
+    Each is named after its directory and needs formatting unless
+    `formatted`.  `license` is written to a LICENSE next to each.
+    """
+    dirnames = dirnames or tuple(f'p{i}' for i in range(n))
+    filenames = []
+    for dirname in dirnames:
+        directory = tmp_path.joinpath(dirname)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = directory.name
+        if formatted:
+            contents = f'[metadata]\nname = {name}\nversion = 1.0\n'
+        else:
+            contents = f'[metadata]\nversion = 1.0\nname = {name}\n'
+        directory.joinpath('setup.cfg').write_text(contents)
+        if license is not None:
+            directory.joinpath('LICENSE').write_text(license)
+        filenames.append(str(directory.joinpath('setup.cfg')))
+    return filenames
+
+
+@pytest.mark.parametrize('jobs', ('0', '2'))
+def test_main_parallel(jobs, tmp_path, capsys):
+    filenames = _setup_cfgs(tmp_path, 'a', 'b', 'd')
+    filenames[2:2] = _setup_cfgs(tmp_path, 'c', formatted=True)
+
+    assert main(('--jobs', jobs, *filenames))
+
+    out, _ = capsys.readouterr()
+    assert out == (
+        f'Rewriting {filenames[0]}\n'
+        f'Rewriting {filenames[1]}\n'
+        f'Rewriting {filenames[3]}\n'
+    )
+    for name in ('a', 'b', 'c', 'd'):
+        assert tmp_path.joinpath(name, 'setup.cfg').read_text() == (
+            f'[metadata]\nname = {name}\nversion = 1.0\n'
+        )
+
+
+def test_main_parallel_nothing_to_do(tmpdir):
+    assert not main(('--jobs', '0'))
+
+
+@pytest.mark.parametrize(
+    ('s', 'expected'),
+    (
+        pytest.param('-1', "must be at least 0, got '-1'", id='negative'),
+        pytest.param('wat', "expected integer, got 'wat'", id='wat'),
+    ),
+)
+def test_jobs_type_error(s, expected):
+    with pytest.raises(argparse.ArgumentTypeError) as excinfo:
+        _jobs_type(s)
+    msg, = excinfo.value.args
+    assert msg == expected
+
+
+def test_cache_dir_default(monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    monkeypatch.setenv('HOME', '/home/user')
+    assert _cache_dir() == '/home/user/.cache/setup-cfg-fmt'
+
+
+def test_cache_skips_formatted_files(cache_home, tmp_path, monkeypatch):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nversion = 1.0\nname = pkg\n')
+    tmp_path.joinpath('README.md').write_text('hi\n')
+
+    assert main(('--cache', str(setup_cfg)))
+    assert not main(('--cache', str(setup_cfg)))
+
+    with mock.patch.object(
+            setup_cfg_fmt, 'format_string',
+            wraps=setup_cfg_fmt.format_string,
+    ) as format_mck:
+        assert not main(('--cache', str(setup_cfg)))
+        # touching the file still hits the cache via its contents
+        os.utime(setup_cfg, ns=(0, 0))
+        assert not main(('--cache', str(setup_cfg)))
+        # but not with different options
+        assert not main(('--cache', '--max-py-version=3.13', str(setup_cfg)))
+    assert format_mck.call_count == 1
+
+
+def test_cache_invalidated_by_adjacent_files(cache_home, tmp_path):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nname = pkg\nversion = 1.0\n')
+
+    assert not main(('--cache', str(setup_cfg)))
+
+    tmp_path.joinpath('tox.ini').write_text('[tox]\nenvlist = pypy3\n')
+    assert main(('--cache', str(setup_cfg)))
+    assert setup_cfg.read_text() == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: Implementation :: PyPy\n'
+    )
+
+
+def test_cache_prune(cache_home, tmp_path):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nname = pkg\nversion = 1.0\n')
+
+    with mock.patch.object(_ResultCache, 'MAX_ENTRIES', 1):
+        assert not main(('--cache', str(setup_cfg)))
+
+    entries = list(cache_home.joinpath('setup-cfg-fmt', 'results').iterdir())
+    assert len(entries) == 1
+
+
+def test_cache_prune_nothing_cached(tmp_path):
+    cache = _ResultCache(str(tmp_path.joinpath('dne')), ())
+    cache.prune()  # does not crash
+
+
+MIT_LICENSE = '''\
+MIT License
+
+Copyright (c) {year} {name}
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+MIT_TEXT = MIT_LICENSE.format(year=2000, name='me')
+
+
+@pytest.fixture
+def license_id_mck():
+    with (
+            mock.patch.dict(setup_cfg_fmt._LICENSE_IDS, clear=True),
+            mock.patch.object(
+                setup_cfg_fmt, '_fuzzy_license_id',
+                wraps=setup_cfg_fmt._fuzzy_license_id,
+            ) as mck,
+    ):
+        yield mck
+
+
+def test_license_id_exact_match(license_id_mck, tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=2, formatted=True, license=MIT_TEXT)
+
+    assert main(filenames)
+
+    assert license_id_mck.call_count == 0
+    for filename in filenames:
+        with open(filename) as f:
+            assert 'license = MIT\n' in f.read()
+
+
+def test_license_id_too_large(license_id_mck, tmp_path):
+    license = MIT_TEXT + 'a' * LICENSE_MAX_SIZE
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=license)
+
+    assert main((filename,))
+
+    assert license_id_mck.call_count == 0
+    with open(filename) as f:
+        assert 'license =' not in f.read()
+
+
+def test_license_id_shared_between_files(license_id_mck, tmp_path):
+    filenames = _setup_cfgs(
+        tmp_path, n=3, formatted=True, license=MIT_TEXT + '(modified)\n',
+    )
+
+    assert main(filenames)
+
+    assert license_id_mck.call_count == 1
+    for filename in filenames:
+        with open(filename) as f:
+            assert 'license = MIT\n' in f.read()
+
+
+def test_license_id_cached_between_runs(license_id_mck, cache_home, tmp_path):
+    filename, = _setup_cfgs(
+        tmp_path, n=1, formatted=True, license=MIT_TEXT + '(modified)\n',
+    )
+
+    assert main(('--cache', filename))
+    setup_cfg_fmt._LICENSE_IDS.clear()
+    with open(filename, 'w') as f:
+        f.write('[metadata]\nname = p0\nversion = 1.0\n')
+    assert main(('--cache', filename))
+
+    assert license_id_mck.call_count == 1
+    with open(filename) as f:
+        assert 'license = MIT\n' in f.read()
+
+
+def test_license_id_not_cached_between_versions(
+        license_id_mck, cache_home, tmp_path,
+):
+    filename, = _setup_cfgs(
+        tmp_path, n=1, formatted=True, license=MIT_TEXT + '(modified)\n',
+    )
+
+    assert main(('--cache', filename))
+    setup_cfg_fmt._LICENSE_IDS.clear()
+    with open(filename, 'w') as f:
+        f.write('[metadata]\nname = p0\nversion = 1.0\n')
+    # such as an upgrade which changed the license matcher
+    with mock.patch.object(
+            setup_cfg_fmt, '_source_digest', return_value='new',
+    ):
+        assert main(('--cache', filename))
+
+    assert license_id_mck.call_count == 2
+    with open(filename) as f:
+        assert 'license = MIT\n' in f.read()
+
+
+# with a single candidate the shingle index is used for every license
+@pytest.mark.parametrize('candidates', (1, setup_cfg_fmt.LICENSE_CANDIDATES))
+@pytest.mark.parametrize(('spdx', 'text'), licenses.LICENSES)
+def test_fuzzy_license_id_matches_identify(
+        spdx, text, candidates, tmp_path, monkeypatch,
+):
+    monkeypatch.setattr(setup_cfg_fmt, 'LICENSE_CANDIDATES', candidates)
+    license_file = tmp_path.joinpath('LICENSE')
+    words = text.split()
+    # perturb the text: drop a word and change another
+    words[len(words) // 3] = 'Wat'
+    del words[len(words) // 2]
+    license_file.write_text(' '.join(words))
+
+    norm = setup_cfg_fmt._norm_license(license_file.read_text())
+    expected = identify.license_id(str(license_file))
+    assert _fuzzy_license_id(norm) == expected
+
+
+@pytest.mark.parametrize('s', ('', 'MIT', 'hello ' * 1000))
+def test_fuzzy_license_id_no_match(s):
+    assert _fuzzy_license_id(setup_cfg_fmt._norm_license(s)) is None
+
+
+def test_setup_cfg_read_once(tmp_path):
+    tmp_path.joinpath('tox.ini').write_text('[tox]\nenvlist = py311\n')
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text(
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        '\n'
+        '[options]\n'
+        'python_requires = >=3.10\n',
+    )
+
+    with mock.patch('builtins.open', wraps=open) as open_mck:
+        assert main((str(setup_cfg),))
+
+    opened = [call.args[0] for call in open_mck.call_args_list]
+    # once to read, it is written through a temporary file
+    assert opened.count(str(setup_cfg)) == 1
+
+
+def test_format_string():
+    ret = format_string(
+        '[metadata]\nversion = 1.0\nname = pkg-name\n',
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 14),
+    )
+    assert ret == '[metadata]\nname = pkg_name\nversion = 1.0\n'
+
+
+def test_format_string_in_memory_project():
+    project = Project.from_files({
+        'README.rst': 'hi\n',
+        'LICENSE': MIT_TEXT,
+        'tox.ini': '[tox]\nenvlist = py310,py311,pypy3\n',
+    })
+
+    with mock.patch.object(os, 'scandir') as scandir:
+        ret = format_string(
+            '[metadata]\nname = pkg\nversion = 1.0\n',
+            context=project,
+            include_version_classifiers=False,
+            min_py_version=None,
+            max_py_version=(3, 14),
+        )
+    assert not scandir.called
+
+    assert ret == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'long_description = file: README.rst\n'
+        'long_description_content_type = text/x-rst\n'
+        'license = MIT\n'
+        'license_files = LICENSE\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: 3\n'
+        '    Programming Language :: Python :: 3 :: Only\n'
+        '    Programming Language :: Python :: Implementation :: CPython\n'
+        '    Programming Language :: Python :: Implementation :: PyPy\n'
+        '\n'
+        '[options]\n'
+        'python_requires = >=3.10\n'
+    )
+    assert project.fs.counts == {
+        ('list_files', ''): 1,
+        ('read', 'LICENSE'): 1,
+        ('read', 'tox.ini'): 1,
+    }
+
+
+def test_format_file_in_memory():
+    fs = MemoryFileSystem({
+        'pkg/setup.cfg': '[metadata]\nversion = 1.0\nname = pkg\n',
+        'pkg/README.md': 'hi\n',
+        'README.rst': 'not in the project\n',
+    })
+
+    assert format_file(
+        'pkg/setup.cfg',
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 14),
+        fs=fs,
+    )
+    assert fs.files['pkg/setup.cfg'] == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'long_description = file: README.md\n'
+        'long_description_content_type = text/markdown\n'
+    )
+
+
+def test_memory_file_system():
+    fs = MemoryFileSystem({'a.txt': 'hello world'})
+
+    assert fs.read_text('a.txt', size=5) == 'hello'
+    assert fs.read_bytes('a.txt') == b'hello world'
+    with pytest.raises(FileNotFoundError):
+        fs.read_text('b.txt')
+    assert fs.stat('a.txt') is None
+
+
+def test_cache_memory_file_system(tmp_path):
+    cache = _ResultCache(str(tmp_path), ())
+    files = {
+        'setup.cfg': '[metadata]\nname = pkg\n',
+        'README.md': 'hi\n',
+    }
+    project = Project.from_files(files)
+
+    assert not cache.is_formatted('setup.cfg', project)
+    cache.mark_formatted('setup.cfg', project, rewritten=False)
+    assert cache.is_formatted('setup.cfg', project)
+
+    # only the contents identify the files
+    assert len(os.listdir(tmp_path)) == 1
+    changed = Project.from_files({**files, 'README.md': 'hello\n'})
+    assert not cache.is_formatted('setup.cfg', changed)
+
+
+def test_read_text_reuses_read_bytes(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_bytes(b'[metadata]\r\nname = \xe2\x98\x83\r\n')
+    fs = FileSystem()
+
+    contents = fs.read_bytes(str(path))
+    path.write_text('changed\n')
+
+    # the contents which were hashed, decoded like `open` would
+    text = fs.read_text(str(path), encoding='UTF-8')
+    assert text == '[metadata]\nname = \N{SNOWMAN}\n'
+    assert text.encode().replace(b'\n', b'\r\n') == contents
+    assert fs.counts == {('read', str(path)): 1}
+    # only once: later reads see later changes
+    assert fs.read_text(str(path)) == 'changed\n'
+
+
+def test_write_text_keeps_mode(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('old\n')
+    path.chmod(0o640)
+
+    FileSystem().write_text(str(path), 'new\n')
+
+    assert path.read_text() == 'new\n'
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ['setup.cfg']
+
+
+def test_write_text_through_symlink(tmp_path):
+    target = tmp_path.joinpath('real.cfg')
+    target.write_text('old\n')
+    link = tmp_path.joinpath('setup.cfg')
+    link.symlink_to(target)
+
+    FileSystem().write_text(str(link), 'new\n')
+
+    assert link.is_symlink()
+    assert target.read_text() == 'new\n'
+
+
+def test_write_text_error_leaves_file_intact(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('old\n')
+
+    with mock.patch.object(os, 'replace', side_effect=OSError):
+        with pytest.raises(OSError):
+            FileSystem().write_text(str(path), 'new\n')
+
+    assert path.read_text() == 'old\n'
+    assert os.listdir(tmp_path) == ['setup.cfg']
+
+
+def test_write_text_read_only(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('old\n')
+
+    with mock.patch.object(os, 'access', return_value=False):
+        with pytest.raises(PermissionError):
+            FileSystem().write_text(str(path), 'new\n')
+
+    assert path.read_text() == 'old\n'
+    assert os.listdir(tmp_path) == ['setup.cfg']
+
+
+def test_write_text_owner_not_kept(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('old\n')
+    inode = path.stat().st_ino
+
+    with mock.patch.object(setup_cfg_fmt, '_chown_like', return_value=False):
+        FileSystem().write_text(str(path), 'new\n')
+
+    # rewritten in place instead
+    assert path.read_text() == 'new\n'
+    assert path.stat().st_ino == inode
+    assert os.listdir(tmp_path) == ['setup.cfg']
+
+
+def test_write_text_read_only_directory(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('old\n')
+    inode = path.stat().st_ino
+
+    with mock.patch.object(tempfile, 'mkstemp', side_effect=PermissionError):
+        FileSystem().write_text(str(path), 'new\n')
+
+    # rewritten in place instead
+    assert path.read_text() == 'new\n'
+    assert path.stat().st_ino == inode
+    assert os.listdir(tmp_path) == ['setup.cfg']
+
+
+def test_chown_like(tmp_path):
+    path = tmp_path.joinpath('f')
+    path.touch()
+    st = path.stat()
+    other = os.stat_result((*st[:4], st.st_uid + 1, *st[5:]))
+
+    with mock.patch.object(os, 'chown') as chown:
+        assert setup_cfg_fmt._chown_like(str(path), st)
+        assert not chown.called
+
+        assert setup_cfg_fmt._chown_like(str(path), other)
+        chown.assert_called_once_with(str(path), st.st_uid + 1, st.st_gid)
+
+        chown.side_effect = PermissionError
+        assert not setup_cfg_fmt._chown_like(str(path), other)
+
+
+def test_fsync_files_read_only(tmp_path):
+    path = tmp_path.joinpath('setup.cfg')
+    path.write_text('hi\n')
+    path.chmod(0o444)
+
+    with mock.patch.object(os, 'open', wraps=os.open) as open_mck:
+        setup_cfg_fmt._fsync_files([str(path)])
+
+    assert open_mck.call_args_list[0] == mock.call(str(path), os.O_RDONLY)
+
+
+def test_format_file_relative_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('README.md').write_text('hi\n')
+    tmp_path.joinpath('setup.cfg').write_text(
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n',
+    )
+
+    fmt = functools.partial(
+        format_file,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 14),
+    )
+    assert fmt('setup.cfg')
+    assert not fmt('setup.cfg')
+
+    assert tmp_path.joinpath('setup.cfg').read_text() == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'long_description = file: README.md\n'
+        'long_description_content_type = text/markdown\n'
+    )
+
+
+def test_project_directory_listed_once(tmp_path):
+    tmp_path.joinpath('README.md').write_text('hi\n')
+    tmp_path.joinpath('LICENSE').write_text('hi\n')
+    tmp_path.joinpath('tox.ini').write_text('[tox]\nenvlist = py311\n')
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nname = pkg\nversion = 1.0\n')
+
+    with (
+            mock.patch.object(os, 'scandir', wraps=os.scandir) as scandir,
+            mock.patch.object(
+                os.path, 'exists', wraps=os.path.exists,
+            ) as exists,
+            mock.patch.object(os.path, 'isfile') as isfile,
+    ):
+        assert main((str(setup_cfg),))
+
+    assert scandir.call_count == 1
+    # only to look for a daemon
+    daemon_socket = setup_cfg_fmt._daemon_socket()
+    assert exists.call_args_list == [mock.call(daemon_socket)]
+    assert isfile.call_count == 0
+
+
+def _budget_project(tmp_path):
+    setup_cfg, = _setup_cfgs(tmp_path, '.', formatted=True, license=MIT_TEXT)
+    tmp_path.joinpath('README.md').write_text('hi\n')
+    tmp_path.joinpath('tox.ini').write_text('[tox]\nenvlist = py311\n')
+    return str(tmp_path), setup_cfg
+
+
+def _format_file_io(filename):
+    fs = FileSystem()
+    format_file(
+        filename,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+        fs=fs,
+    )
+    return fs.counts
+
+
+def test_format_file_io_budget(tmp_path):
+    dirname, setup_cfg = _budget_project(tmp_path)
+
+    assert _format_file_io(setup_cfg) == {
+        ('list_files', dirname): 1,
+        ('read', setup_cfg): 1,
+        ('read', os.path.join(dirname, 'LICENSE')): 1,
+        ('read', os.path.join(dirname, 'tox.ini')): 1,
+        ('write', setup_cfg): 1,
+    }
+
+    # already formatted: nothing is written
+    assert _format_file_io(setup_cfg) == {
+        ('list_files', dirname): 1,
+        ('read', setup_cfg): 1,
+        ('read', os.path.join(dirname, 'LICENSE')): 1,
+        ('read', os.path.join(dirname, 'tox.ini')): 1,
+    }
+
+
+def test_process_file_io_budget_cached(tmp_path):
+    dirname, setup_cfg = _budget_project(tmp_path)
+    license_file = os.path.join(dirname, 'LICENSE')
+    tox_ini = os.path.join(dirname, 'tox.ini')
+    readme = os.path.join(dirname, 'README.md')
+    inputs = (setup_cfg, readme, license_file, tox_ini)
+    assert main((setup_cfg,))
+
+    cache = _ResultCache(str(tmp_path.joinpath('cache')), ())
+    process_file = functools.partial(
+        setup_cfg_fmt._process_file,
+        cache=cache,
+        write=True,
+        fsync=False,
+        diff=False,
+        record=False,
+        check_classifiers=False,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+        license_db=None,
+    )
+
+    def _process_file_io():
+        fs = FileSystem()
+        with mock.patch.object(setup_cfg_fmt, 'FileSystem', return_value=fs):
+            changed, _, _, _ = process_file(setup_cfg)
+        assert not changed
+        return fs.counts
+
+    # not cached yet: each input is read once to be hashed and formatted
+    assert _process_file_io() == {
+        ('list_files', dirname): 1,
+        ('read', setup_cfg): 1,
+        ('read', readme): 1,
+        ('read', license_file): 1,
+        ('read', tox_ini): 1,
+        **{('stat', path): 1 for path in inputs},
+    }
+
+    # cached: the inputs are only stat'd
+    assert _process_file_io() == {
+        ('list_files', dirname): 1,
+        **{('stat', path): 1 for path in inputs},
+    }
+
+
+@pytest.mark.parametrize(
+    ('envlist', 'expected'),
+    (
+        pytest.param('', (), id='empty'),
+        pytest.param('py,pre-commit', ('py', 'pre'), id='simple'),
+        pytest.param('\n    py39\n    pypy3\n', ('py39', 'pypy3'), id='lines'),
+        pytest.param(
+            'py{39,310,311}-django{40,50}, docs',
+            ('py39', 'py310', 'py311', 'docs'),
+            id='generative',
+        ),
+        pytest.param('py3{9-11}', ('py39', 'py310', 'py311'), id='range'),
+        pytest.param(
+            '{py3,pypy3}{,-foo}-bar,py{39-dev,310}',
+            ('py3', 'pypy3', 'py39', 'py310'),
+            id='dashes inside braces',
+        ),
+    ),
+)
+def test_project_tox_envs(envlist, expected, tmp_path):
+    tmp_path.joinpath('tox.ini').write_text(f'[tox]\nenvlist = {envlist}\n')
+
+    project = Project(str(tmp_path.joinpath('setup.cfg')))
+
+    assert project.tox_envs == expected
+
+
+def test_project_tox_envs_no_tox_ini(tmp_path):
+    assert Project(str(tmp_path.joinpath('setup.cfg'))).tox_envs == ()
+
+
+def test_project_tox_envs_large_matrix_not_expanded(tmp_path):
+    factors = '-'.join(f'f{i}{{{",".join("abcdefghij")}}}' for i in range(20))
+    envlist = f'py{{310,311}}-{factors}'
+    tmp_path.joinpath('tox.ini').write_text(f'[tox]\nenvlist = {envlist}\n')
+
+    project = Project(str(tmp_path.joinpath('setup.cfg')))
+
+    assert project.tox_envs == ('py310', 'py311')
+
+
+def test_imp_classifiers_generative_envlist(tmp_path):
+    tmp_path.joinpath('tox.ini').write_text(
+        '[tox]\nenvlist = {py3,pypy3}-django{40,50}\n',
+    )
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nname = pkg\nversion = 1.0\n')
+
+    with mock.patch('builtins.open', wraps=open) as open_mck:
+        assert main((str(setup_cfg),))
+
+    opened = [call.args[0] for call in open_mck.call_args_list]
+    assert opened.count(str(tmp_path.joinpath('tox.ini'))) == 1
+    assert setup_cfg.read_text() == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'classifiers =\n'
+        '    Programming Language :: Python :: Implementation :: CPython\n'
+        '    Programming Language :: Python :: Implementation :: PyPy\n'
+    )
+
+
+def test_newlines_only_not_rewritten(tmp_path):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_bytes(b'[metadata]\r\nname = pkg\r\nversion = 1.0\r\n')
+    os.utime(setup_cfg, ns=(0, 0))
+
+    assert not main((str(setup_cfg),))
+
+    assert setup_cfg.read_bytes() == (
+        b'[metadata]\r\nname = pkg\r\nversion = 1.0\r\n'
+    )
+    assert setup_cfg.stat().st_mtime_ns == 0
+
+
+@pytest.mark.parametrize(
+    ('option', 'expected'),
+    (
+        # the file and its directory for each rewritten file
+        ('never', 0), ('file', 4), ('batch', 4),
+    ),
+)
+def test_main_fsync(option, expected, tmp_path):
+    filenames = _setup_cfgs(tmp_path, 'a', 'b')
+    # already formatted, not written
+    filenames += _setup_cfgs(tmp_path, 'c', formatted=True)
+
+    with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync_mck:
+        assert main((f'--fsync={option}', *filenames))
+
+    assert fsync_mck.call_count == expected
+    assert tmp_path.joinpath('a', 'setup.cfg').read_text() == (
+        '[metadata]\nname = a\nversion = 1.0\n'
+    )
+
+
+def test_check_does_not_write(tmp_path, capsys):
+    filenames = _setup_cfgs(tmp_path, n=2)
+    with open(filenames[1], 'w') as f:
+        f.write('[metadata]\nname = p1\nversion = 1.0\n')
+
+    assert main(('--check', *filenames))
+
+    out, _ = capsys.readouterr()
+    assert out == f'Would rewrite {filenames[0]}\n'
+    with open(filenames[0]) as f:
+        assert f.read() == '[metadata]\nversion = 1.0\nname = p0\n'
+
+
+def test_check_does_not_populate_cache(cache_home, tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=1)
+
+    assert main(('--cache', '--check', *filenames))
+    assert main(('--cache', '--check', *filenames))
+
+
+def test_diff(tmp_path, capsys):
+    filename, = _setup_cfgs(tmp_path, n=1)
+
+    assert main(('--diff', filename))
+
+    out, _ = capsys.readouterr()
+    assert out == (
+        f'--- {filename}\n'
+        f'+++ {filename}\n'
+        f'@@ -1,3 +1,3 @@\n'
+        f' [metadata]\n'
+        f'+name = p0\n'
+        f' version = 1.0\n'
+        f'-name = p0\n'
+    )
+    with open(filename) as f:
+        assert f.read() == '[metadata]\nversion = 1.0\nname = p0\n'
+
+
+def test_diff_no_changes(tmp_path, capsys):
+    filename, = _setup_cfgs(tmp_path, n=1)
+    assert main((filename,))
+    capsys.readouterr()
+
+    assert not main(('--diff', filename))
+
+    out, _ = capsys.readouterr()
+    assert out == ''
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_fail_fast(jobs, tmp_path, capsys):
+    filenames = _setup_cfgs(tmp_path, n=20)
+
+    assert main(('--check', '--fail-fast', '--jobs', jobs, *filenames))
+
+    out, _ = capsys.readouterr()
+    assert out == f'Would rewrite {filenames[0]}\n'
+
+
+def test_fail_fast_requires_check_or_diff(tmp_path, capsys):
+    filenames = _setup_cfgs(tmp_path, n=2)
+
+    with pytest.raises(SystemExit):
+        main(('--fail-fast', *filenames))
+
+    _, err = capsys.readouterr()
+    assert '--fail-fast requires --check or --diff' in err
+    # nothing was written
+    for filename in filenames:
+        with open(filename) as f:
+            assert f.read().startswith('[metadata]\nversion = 1.0\n')
+
+
+format_many_opts = functools.partial(
+    format_many,
+    include_version_classifiers=False,
+    min_py_version=None,
+    max_py_version=(3, 14),
+)
+
+
+def test_format_many(tmp_path):
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=MIT_TEXT)
+    missing = str(tmp_path.joinpath('missing/setup.cfg'))
+    items = [
+        filename,
+        Document('formatted', '[metadata]\nname = pkg\nversion = 1.0\n'),
+        Document('no metadata', '[options]\npackages = find:\n'),
+        Document(
+            'bad python_requires',
+            '[metadata]\nname = pkg\n\n[options]\npython_requires = >=3.x\n',
+        ),
+        missing,
+    ]
+
+    results = {result.name: result for result in format_many_opts(items)}
+
+    assert results[filename].changed
+    assert results[filename].error is None
+    assert 'license = MIT' in str(results[filename].contents)
+    assert results[filename].diff == ''
+    assert results[filename].spans[-1].name == 'format_file'
+    # not written by default
+    assert 'license' not in tmp_path.joinpath(filename).read_text()
+
+    assert not results['formatted'].changed
+    assert results['formatted'].error is None
+
+    for name, error_type in (
+            ('no metadata', KeyError),
+            ('bad python_requires', ValueError),
+            (missing, FileNotFoundError),
+    ):
+        assert not results[name].changed
+        assert results[name].contents is None
+        assert isinstance(results[name].error, error_type)
+
+
+def test_format_many_write_and_diff(tmp_path):
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=MIT_TEXT)
+    document = Document('setup.cfg', '[metadata]\nversion = 1\nname = pkg\n')
+
+    results = list(
+        format_many_opts((filename, document), write=True, diff=True),
+    )
+
+    assert [result.name for result in results] == [filename, 'setup.cfg']
+    assert all(result.changed for result in results)
+    assert results[0].diff.startswith(f'--- {filename}\n')
+    assert results[1].diff.startswith('--- setup.cfg\n')
+    assert results[0].contents == tmp_path.joinpath(filename).read_text()
+
+
+def test_format_many_parallel(tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=5, formatted=True, license=MIT_TEXT)
+    spans: list[setup_cfg_fmt.Span] = []
+    items = (*filenames, Document('bad', 'garbage'))
+
+    add_span_hook(spans.append)
+    try:
+        results = list(format_many_opts(iter(items), jobs=2))
+    finally:
+        remove_span_hook(spans.append)
+
+    assert sorted(result.name for result in results) == sorted(
+        (*filenames, 'bad'),
+    )
+    by_name = {result.name: result for result in results}
+    assert all(by_name[filename].changed for filename in filenames)
+    assert isinstance(by_name['bad'].error, configparser.Error)
+    # replayed in the parent
+    file_spans = [span for span in spans if span.name == 'format_file']
+    assert len(file_spans) == len(items)
+    assert os.getpid() not in {span.pid for span in file_spans}
+
+
+@pytest.mark.parametrize('ordered', (True, False))
+def test_imap_bounded_in_flight(ordered):
+    consumed = []
+
+    def _items():
+        for i in range(100):
+            consumed.append(i)
+            yield -i
+
+    results = setup_cfg_fmt._imap(abs, _items(), jobs=2, ordered=ordered)
+    with contextlib.closing(results):
+        assert next(results) in range(4)
+        assert len(consumed) <= 4
+
+        rest = list(results)
+        assert len(consumed) == 100
+    if ordered:
+        assert rest == list(range(1, 100))
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_directory_arguments(jobs, tmp_path, capsys):
+    found = _setup_cfgs(tmp_path, 'a', 'b/c', 'b/d', 'e')
+    _setup_cfgs(
+        tmp_path,
+        '.git', '.tox/py', 'venv', 'node_modules/pkg', 'b/build', 'e/f.egg',
+    )
+    tmp_path.joinpath('b/setup.cfg').mkdir()  # not a file
+    tmp_path.joinpath('z').symlink_to(tmp_path.joinpath('a'))
+
+    args = (
+        '--check', '--jobs', jobs, '--exclude', 'build', '--exclude', '*.egg',
+    )
+    assert main((*args, str(tmp_path)))
+
+    out, _ = capsys.readouterr()
+    assert out == ''.join(f'Would rewrite {filename}\n' for filename in found)
+
+
+def test_directory_arguments_exclude_path(tmp_path, capsys):
+    found = _setup_cfgs(tmp_path, 'a', 'b/a')
+    explicit, = _setup_cfgs(tmp_path, 'c/a')
+
+    assert main(('--check', '--exclude', '*/c/a', str(tmp_path), explicit))
+
+    out, _ = capsys.readouterr()
+    expected = (*found, explicit)
+    assert out == ''.join(f'Would rewrite {f}\n' for f in expected)
+
+
+def test_walk_unreadable_directory(tmp_path):
+    missing = str(tmp_path.joinpath('missing'))
+    assert list(setup_cfg_fmt._walk(missing, None)) == []
+
+
+def _git(*cmd, cwd):
+    subprocess.check_call(
+        ('git', '-c', 'user.name=u', '-c', 'user.email=u@u', *cmd), cwd=cwd,
+    )
+
+
+def test_changed_since(tmp_path, capsys, monkeypatch):
+    (
+        unchanged, setup_cfg_changed, readme_changed, license_deleted,
+        tox_added, other_changed,
+    ) = _setup_cfgs(tmp_path, 'a', 'b', 'c', 'd', 'e', 'f')
+    tmp_path.joinpath('c/README.md').write_text('hi\n')
+    tmp_path.joinpath('d/LICENSE').write_text('license\n')
+    tmp_path.joinpath('f/other.txt').write_text('hi\n')
+    _git('init', '--quiet', cwd=tmp_path)
+    _git('add', '.', cwd=tmp_path)
+    _git('commit', '--quiet', '-m', 'initial', cwd=tmp_path)
+    ref = subprocess.check_output(
+        ('git', 'rev-parse', 'HEAD'), cwd=tmp_path, text=True,
+    ).strip()
+
+    with open(setup_cfg_changed, 'a') as f:
+        f.write('description = hi\n')
+    tmp_path.joinpath('c/README.md').write_text('hello\n')
+    _git('commit', '--quiet', '-am', 'changes', cwd=tmp_path)
+    tmp_path.joinpath('d/LICENSE').unlink()
+    tmp_path.joinpath('e/tox.ini').write_text('[tox]\nenvlist = py312\n')
+    tmp_path.joinpath('f/other.txt').write_text('hello\n')
+    untracked, = _setup_cfgs(tmp_path, 'g/h')
+
+    monkeypatch.chdir(tmp_path.joinpath('a'))
+    assert main(('--check', '--changed-since', ref, str(tmp_path)))
+
+    out, _ = capsys.readouterr()
+    expected = (
+        setup_cfg_changed, readme_changed, license_deleted, tox_added,
+        untracked,
+    )
+    assert out == ''.join(f'Would rewrite {f}\n' for f in expected)
+
+
+def test_changed_since_git_error(tmp_path, capsys, monkeypatch):
+    _git('init', '--quiet', cwd=tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    assert main(('--changed-since', 'does-not-exist', str(tmp_path))) == 1
+
+    _, err = capsys.readouterr()
+    assert 'does-not-exist' in err
+
+
+def test_changed_since_not_a_repository(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('GIT_CEILING_DIRECTORIES', str(tmp_path))
+
+    assert main(('--changed-since', 'HEAD', str(tmp_path))) == 1
+
+    _, err = capsys.readouterr()
+    assert 'not a git repository' in err
+
+
+def test_stdin(tmp_path, capsys, monkeypatch):
+    tmp_path.joinpath('README.md').write_text('hi\n')
+    tmp_path.joinpath('setup.cfg').write_text('[metadata]\nname = pkg\n')
+    monkeypatch.setattr(
+        sys, 'stdin', io.StringIO('[metadata]\nversion = 1.0\nname = pkg\n'),
+    )
+
+    stdin_filename = str(tmp_path.joinpath('setup.cfg'))
+    assert not main(('-', '--stdin-filename', stdin_filename))
+
+    out, _ = capsys.readouterr()
+    assert out == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'long_description = file: README.md\n'
+        'long_description_content_type = text/markdown\n'
+    )
+    # the file on disk is untouched
+    setup_cfg_contents = tmp_path.joinpath('setup.cfg').read_text()
+    assert setup_cfg_contents == '[metadata]\nname = pkg\n'
+
+
+def test_stdin_default_filename(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('README.rst').write_text('hi\n')
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('[metadata]\nname = pkg\n'))
+
+    assert not main(('-',))
+
+    out, _ = capsys.readouterr()
+    assert out == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'long_description = file: README.rst\n'
+        'long_description_content_type = text/x-rst\n'
+    )
+
+
+def test_stdin_filename_missing_directory(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('[metadata]\nname = pkg\n'))
+
+    stdin_filename = str(tmp_path.joinpath('missing', 'setup.cfg'))
+    assert not main(('-', '--stdin-filename', stdin_filename))
+
+    out, _ = capsys.readouterr()
+    assert out == '[metadata]\nname = pkg\n'
+
+
+@pytest.mark.parametrize(
+    ('contents', 'expected_retv', 'expected_out'),
+    (
+        ('[metadata]\nname = pkg\nversion = 1.0\n', 0, ''),
+        (
+            '[metadata]\nversion = 1.0\nname = pkg\n', 1,
+            'Would rewrite setup.cfg\n',
+        ),
+    ),
+)
+def test_stdin_check(
+        contents, expected_retv, expected_out, tmp_path, capsys, monkeypatch,
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(contents))
+
+    assert main(('-', '--check')) == expected_retv
+
+    out, _ = capsys.readouterr()
+    assert out == expected_out
+
+
+def test_stdin_diff(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        sys, 'stdin', io.StringIO('[metadata]\nversion = 1.0\nname = pkg\n'),
+    )
+
+    assert main(('-', '--diff', '--stdin-filename', 'setup.cfg'))
+
+    out, _ = capsys.readouterr()
+    assert out == (
+        '--- setup.cfg\n'
+        '+++ setup.cfg\n'
+        '@@ -1,3 +1,3 @@\n'
+        ' [metadata]\n'
+        '+name = pkg\n'
+        ' version = 1.0\n'
+        '-name = pkg\n'
+    )
+
+
+def test_stdin_with_other_filenames(capsys):
+    with pytest.raises(SystemExit):
+        main(('-', 'setup.cfg'))
+
+    _, err = capsys.readouterr()
+    assert '`-` cannot be combined with other filenames' in err
+
+
+@pytest.fixture
+def daemon():
+    path = setup_cfg_fmt._daemon_socket()
+    os.makedirs(os.path.dirname(path))
+    server = setup_cfg_fmt._daemon_server(path)
+    thread = threading.Thread(target=server.serve_forever, args=(.01,))
+    thread.start()
+    # handle requests in this process so they can be observed
+    with mock.patch.object(
+            socketserver.ForkingMixIn, 'process_request',
+            socketserver.BaseServer.process_request,
+    ), mock.patch.object(
+            setup_cfg_fmt, '_daemon_run', wraps=setup_cfg_fmt._daemon_run,
+    ) as daemon_run:
+        yield daemon_run
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_daemon_formats_files(daemon, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath('setup.cfg').write_text(
+        '[metadata]\nversion = 1.0\nname = pkg\n',
+    )
+
+    assert main(('setup.cfg',))
+
+    assert daemon.call_count == 1
+    out, _ = capsys.readouterr()
+    assert out == 'Rewriting setup.cfg\n'
+    assert tmp_path.joinpath('setup.cfg').read_text() == (
+        '[metadata]\nname = pkg\nversion = 1.0\n'
+    )
+
+
+def test_daemon_relays_errors(daemon, tmp_path, capsys):
+    assert main((str(tmp_path.joinpath('dne', 'setup.cfg')),))
+
+    _, err = capsys.readouterr()
+    assert 'FileNotFoundError' in err
+
+
+def test_daemon_relays_argument_errors(daemon, capsys):
+    ret = setup_cfg_fmt._daemon_request(
+        setup_cfg_fmt._daemon_socket(), ['--jobs', '-1', 'setup.cfg'],
+    )
+    assert ret is not None
+    assert ret['retv'] == 2
+
+
+def test_daemon_stale(daemon, tmp_path):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nversion = 1.0\nname = pkg\n')
+
+    with mock.patch.object(
+            setup_cfg_fmt, '_daemon_token', side_effect=('old', 'new'),
+    ):
+        assert main((str(setup_cfg),))
+
+    # formatted in-process instead
+    assert daemon.call_count == 0
+    assert setup_cfg.read_text() == '[metadata]\nname = pkg\nversion = 1.0\n'
+
+
+def test_daemon_token_includes_data_packages():
+    token = setup_cfg_fmt._daemon_token()
+    assert f'{os.sep}identify{os.sep}' in token
+    assert f'{os.sep}trove_classifiers{os.sep}' in token
+
+
+def test_daemon_concurrent_requests(tmp_path):
+    path = setup_cfg_fmt._daemon_socket()
+    os.makedirs(os.path.dirname(path))
+    server = setup_cfg_fmt._daemon_server(path)
+    thread = threading.Thread(target=server.serve_forever, args=(.01,))
+    thread.start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # a request which is still being sent occupies its handler
+            sock.connect(path)
+            assert setup_cfg_fmt._daemon_request(path, []) is not None
+            sock.sendall(b'{"token": "old"}\n')
+            assert sock.recv(1024) == b'{"stale": true}\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_daemon_not_responding(tmp_path, monkeypatch):
+    monkeypatch.setattr(setup_cfg_fmt, 'DAEMON_TIMEOUT', .01)
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nversion = 1.0\nname = pkg\n')
+
+    path = setup_cfg_fmt._daemon_socket()
+    os.makedirs(os.path.dirname(path))
+    # such as a stopped daemon: connections are queued but never accepted
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+        sock.listen()
+
+        assert main((str(setup_cfg),))
+
+    # formatted in-process instead
+    assert setup_cfg.read_text() == '[metadata]\nname = pkg\nversion = 1.0\n'
+
+
+def test_daemon_already_running(daemon, capsys):
+    assert main(('--daemon',))
+
+    _, err = capsys.readouterr()
+    assert err.startswith('daemon is already running: ')
+
+
+def test_daemon_serve(tmp_path, capsys):
+    path = setup_cfg_fmt._daemon_socket()
+    # left behind by a killed daemon
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+    with mock.patch.object(
+            socketserver.UnixStreamServer, 'serve_forever',
+            side_effect=KeyboardInterrupt,
+    ):
+        assert not main(('--daemon',))
+
+    _, err = capsys.readouterr()
+    assert err == f'listening on {path}\n'
+    assert not os.path.exists(path)
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+
+
+def test_daemon_serve_is_warm(tmp_path):
+    warm = (
+        'argparse', 'concurrent.futures', 'json',
+        'identify.identify', 'identify.vendor.licenses', 'trove_classifiers',
+    )
+    caches = (
+        setup_cfg_fmt._normed_licenses,
+        setup_cfg_fmt._exact_license_ids,
+        setup_cfg_fmt._license_shingles,
+    )
+
+    def serve_forever(self):
+        # forked children inherit whatever the parent has already done
+        assert all(mod in sys.modules for mod in warm)
+        assert all(cache.cache_info().currsize for cache in caches)
+        raise KeyboardInterrupt
+
+    for cache in caches:
+        cache.cache_clear()
+    with (
+            mock.patch.dict(sys.modules),
+            mock.patch.object(
+                socketserver.UnixStreamServer, 'serve_forever',
+                serve_forever,
+            ),
+    ):
+        for mod in warm:
+            sys.modules.pop(mod, None)
+        assert not main(('--daemon',))
+
+
+def _apply_edits(contents, edits):
+    # lines as counted by LSP: only split on `\n`, `\r\n` and `\r`
+    lines = io.StringIO(contents, newline='').readlines()
+    for edit in reversed(edits):
+        start = edit['range']['start']['line']
+        end = edit['range']['end']['line']
+        # only ever the end of a last line without a line break
+        end += bool(edit['range']['end']['character'])
+        lines[start:end] = [edit['newText']]
+    return ''.join(lines)
+
+
+def _lsp_messages(*msgs):
+    ret = b''
+    for msg in msgs:
+        body = json.dumps({'jsonrpc': '2.0', **msg}).encode()
+        ret += f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+    return io.BytesIO(ret)
+
+
+def _lsp_responses(stdout):
+    stdout.seek(0)
+    ret = []
+    while (msg := setup_cfg_fmt._lsp_read(stdout)) is not None:
+        ret.append(msg)
+    return ret
+
+
+def _lsp_run(*msgs, args=()):
+    stdin = _lsp_messages(*msgs)
+    stdout = io.BytesIO()
+    with mock.patch.object(
+            sys, 'stdin', mock.Mock(buffer=stdin),
+    ), mock.patch.object(sys, 'stdout', mock.Mock(buffer=stdout)):
+        ret = main(('--lsp', *args))
+    return ret, _lsp_responses(stdout)
+
+
+def test_lsp_formatting(tmp_path):
+    tmp_path.joinpath('README.md').write_text('hi\n')
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('on disk contents are not used\n')
+    uri = setup_cfg.as_uri()
+    text = (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        '\n'
+        '[options]\n'
+        'install_requires =\n'
+        '    b\n'
+        '    a\n'
+    )
+
+    ret, responses = _lsp_run(
+        {'id': 1, 'method': 'initialize', 'params': {}},
+        {'method': 'initialized', 'params': {}},
+        {
+            'method': 'textDocument/didOpen',
+            'params': {'textDocument': {'uri': uri, 'text': 'wat'}},
+        },
+        {
+            'method': 'textDocument/didChange',
+            'params': {
+                'textDocument': {'uri': uri},
+                'contentChanges': [{'text': text}],
+            },
+        },
+        {
+            'id': 2,
+            'method': 'textDocument/formatting',
+            'params': {'textDocument': {'uri': uri}, 'options': {}},
+        },
+        {
+            'method': 'textDocument/didClose',
+            'params': {'textDocument': {'uri': uri}},
+        },
+        {'id': 3, 'method': 'shutdown'},
+        {'method': 'exit'},
+    )
+
+    assert ret == 0
+    initialize, formatting, shutdown = responses
+    assert initialize['result']['capabilities'] == {
+        'textDocumentSync': 1,
+        'documentFormattingProvider': True,
+    }
+    # only the changed lines are edited
+    assert [edit['range'] for edit in formatting['result']] == [
+        {
+            'start': {'line': 3, 'character': 0},
+            'end': {'line': 3, 'character': 0},
+        },
+        {
+            'start': {'line': 6, 'character': 0},
+            'end': {'line': 6, 'character': 0},
+        },
+        {
+            'start': {'line': 7, 'character': 0},
+            'end': {'line': 8, 'character': 0},
+        },
+    ]
+    assert _apply_edits(text, formatting['result']) == (
+        '[metadata]\n'
+        'name = pkg\n'
+        'version = 1.0\n'
+        'long_description = file: README.md\n'
+        'long_description_content_type = text/markdown\n'
+        '\n'
+        '[options]\n'
+        'install_requires =\n'
+        '    a\n'
+        '    b\n'
+    )
+    assert shutdown == {'jsonrpc': '2.0', 'id': 3, 'result': None}
+
+
+def test_lsp_formatting_unopened_document(tmp_path):
+    setup_cfg = tmp_path.joinpath('setup.cfg')
+    setup_cfg.write_text('[metadata]\nname = pkg\nversion = 1.0\n')
+
+    ret, responses = _lsp_run(
+        {
+            'id': 1,
+            'method': 'textDocument/formatting',
+            'params': {'textDocument': {'uri': setup_cfg.as_uri()}},
+        },
+    )
+
+    assert ret == 1  # stdin closed without `exit`
+    assert responses == [{'jsonrpc': '2.0', 'id': 1, 'result': []}]
+
+
+def test_lsp_formatting_error(tmp_path):
+    uri = tmp_path.joinpath('setup.cfg').as_uri()
+
+    _, responses = _lsp_run(
+        {
+            'method': 'textDocument/didOpen',
+            'params': {'textDocument': {'uri': uri, 'text': '[options]\n'}},
+        },
+        {
+            'id': 1,
+            'method': 'textDocument/formatting',
+            'params': {'textDocument': {'uri': uri}},
+        },
+        args=('--cache',),
+    )
+
+    error = responses[0]['error']
+    assert error == {'code': -32603, 'message': "KeyError: 'metadata'"}
+
+
+def test_lsp_unknown_method_and_exit_without_shutdown():
+    ret, responses = _lsp_run(
+        {'id': 1, 'method': 'textDocument/hover', 'params': {}},
+        {'method': 'exit'},
+    )
+
+    assert ret == 1
+    assert responses == [
+        {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'error': {
+                'code': -32601,
+                'message': 'unknown method: textDocument/hover',
+            },
+        },
+    ]
+
+
+def test_text_edits():
+    contents = 'a\nb\nc\nd\n'
+    new_contents = 'a\nc\nd\ne\n'
+
+    edits = setup_cfg_fmt._text_edits(contents, new_contents)
+
+    assert len(edits) == 2
+    assert _apply_edits(contents, edits) == new_contents
+
+
+def test_text_edits_no_line_break_at_end():
+    contents = '[metadata]\nname = \N{SNOWMAN}\U0001f40d'
+    new_contents = '[metadata]\nname = \N{SNOWMAN}\U0001f40d\n'
+
+    edits = setup_cfg_fmt._text_edits(contents, new_contents)
+
+    assert edits == [
+        {
+            'range': {
+                'start': {'line': 1, 'character': 0},
+                # the snake is two UTF-16 code units
+                'end': {'line': 1, 'character': 10},
+            },
+            'newText': 'name = \N{SNOWMAN}\U0001f40d\n',
+        },
+    ]
+    assert _apply_edits(contents, edits) == new_contents
+
+
+def test_text_edits_only_lsp_line_endings():
+    contents = 'a\nb\x0cc\r\nd\re\u2028f\n'
+    new_contents = 'a\nb\x0cc\r\nd\rg\u2028f\n'
+
+    edits = setup_cfg_fmt._text_edits(contents, new_contents)
+
+    assert edits == [
+        {
+            'range': {
+                'start': {'line': 3, 'character': 0},
+                'end': {'line': 4, 'character': 0},
+            },
+            'newText': 'g\u2028f\n',
+        },
+    ]
+    assert _apply_edits(contents, edits) == new_contents
+
+
+def _imported_modules(code):
+    cmd = (sys.executable, '-X', 'importtime', '-c', code)
+    proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return {
+        line.split('|')[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith('import time:')
+    }
+
+
+def test_import_is_lazy():
+    # modules which are only needed for some code paths (and which are
+    # slow to import) must not be imported at startup
+    slow = {
+        'argparse',
+        'concurrent.futures',
+        'difflib',
+        'hashlib',
+        'identify.identify',
+        'identify.vendor.licenses',
+        'importlib.metadata',
+        'json',
+        'socket',
+        'sqlite3',
+        'urllib.request',
+    }
+
+    baseline = _imported_modules('')
+    imported = _imported_modules('import setup_cfg_fmt') - baseline
+
+    assert 'setup_cfg_fmt' in imported
+    assert not imported & slow
+
+
+def test_profile(tmp_path, capsys):
+    filenames = _setup_cfgs(tmp_path, n=3, formatted=True, license=MIT_TEXT)
+
+    assert main(('--profile', '--jobs', '2', *filenames))
+
+    out, err = capsys.readouterr()
+    assert out == ''.join(f'Rewriting {filename}\n' for filename in filenames)
+    header, *lines = err.splitlines()
+    assert header.split() == [
+        'phase', 'count', 'total', '%', 'p50', 'p90', 'p99', 'max',
+    ]
+    phases = {line.split()[0]: line.split()[1] for line in lines}
+    assert phases == {
+        'project': '3',
+        'read': '3',
+        'parse': '3',
+        'readme': '3',
+        'license': '3',
+        'tox': '3',
+        'python_requires': '3',
+        'requires': '3',
+        'classifiers': '3',
+        'serialize': '3',
+        'write': '3',
+    }
+
+
+def test_profile_json(cache_home, tmp_path, capsys):
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=MIT_TEXT)
+    report_json = tmp_path.joinpath('report.json')
+
+    assert main(('--cache', filename))
+    assert not main(('--cache', '--profile-json', str(report_json), filename))
+
+    _, err = capsys.readouterr()
+    assert err == ''
+    report = json.loads(report_json.read_text())
+    assert set(report) == {'project', 'cache'}
+    assert set(report['cache']) == {
+        'count', 'total', 'p50', 'p90', 'p99', 'max',
+    }
+    assert report['cache']['count'] == 1
+
+
+def test_not_profiling_records_nothing(tmp_path):
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=MIT_TEXT)
+
+    with mock.patch.object(setup_cfg_fmt, '_profile_report') as report:
+        assert main((filename,))
+
+    assert setup_cfg_fmt._recorder.get() is None
+    assert not report.called
+
+
+def test_trace(tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=3, formatted=True, license=MIT_TEXT)
+    trace_json = tmp_path.joinpath('trace.json')
+
+    assert main(('--trace', str(trace_json), '--jobs', '2', *filenames))
+
+    events = json.loads(trace_json.read_text())['traceEvents']
+    assert [event['ts'] for event in events] == sorted(
+        event['ts'] for event in events
+    )
+    files = {
+        event['args']['filename']: event
+        for event in events
+        if event['cat'] == 'file'
+    }
+    assert set(files) == set(filenames)
+    # recorded in the workers
+    assert os.getpid() not in {event['pid'] for event in files.values()}
+
+    for event in events:
+        assert event['ph'] == 'X'
+        file_event = files[event['args']['filename']]
+        assert (event['pid'], event['tid']) == (
+            file_event['pid'], file_event['tid'],
+        )
+        assert file_event['ts'] <= event['ts']
+        assert (
+            event['ts'] + event['dur'] <=
+            file_event['ts'] + file_event['dur']
+        )
+    license_events = [e for e in events if e['name'] == 'license']
+    assert len(license_events) == 3
+
+
+def test_span_hook(tmp_path):
+    filename, = _setup_cfgs(tmp_path, n=1, formatted=True, license=MIT_TEXT)
+    spans: list[setup_cfg_fmt.Span] = []
+
+    add_span_hook(spans.append)
+    try:
+        assert format_file(
+            filename,
+            include_version_classifiers=False,
+            min_py_version=None,
+            max_py_version=(3, 13),
+        )
+    finally:
+        remove_span_hook(spans.append)
+
+    assert spans[-1].name == 'format_file'
+    assert {span.filename for span in spans} == {filename}
+    assert {span.pid for span in spans} == {os.getpid()}
+    assert {span.tid for span in spans} == {threading.get_native_id()}
+    assert 'serialize' in {span.name for span in spans}
+
+    # nothing is reported once the hook is removed
+    recorded = len(spans)
+    assert not format_file(
+        filename,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+    )
+    assert len(spans) == recorded
+
+
+def test_span_hook_threads(tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=2, formatted=True, license=MIT_TEXT)
+    spans: list[setup_cfg_fmt.Span] = []
+    # both files are being formatted at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _clean_sections(cfg):
+        barrier.wait()
+        return orig_clean_sections(cfg)
+
+    orig_clean_sections = setup_cfg_fmt._clean_sections
+    fmt = functools.partial(
+        format_file,
+        include_version_classifiers=False,
+        min_py_version=None,
+        max_py_version=(3, 13),
+    )
+    add_span_hook(spans.append)
+    try:
+        with mock.patch.object(
+                setup_cfg_fmt, '_clean_sections', _clean_sections,
+        ):
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                assert all(executor.map(fmt, filenames))
+    finally:
+        remove_span_hook(spans.append)
+
+    for filename in filenames:
+        names = [span.name for span in spans if span.filename == filename]
+        assert names.count('format_file') == 1
+        assert 'parse' in names
+        assert 'serialize' in names
+
+
+def test_span_hook_replays_worker_spans(tmp_path):
+    filenames = _setup_cfgs(tmp_path, n=3, formatted=True, license=MIT_TEXT)
+    spans: list[setup_cfg_fmt.Span] = []
+
+    add_span_hook(spans.append)
+    try:
+        assert main(('--jobs', '2', *filenames))
+    finally:
+        remove_span_hook(spans.append)
+
+    file_spans = [span for span in spans if span.name == 'format_file']
+    assert [span.filename for span in file_spans] == filenames
+    assert os.getpid() not in {span.pid for span in spans}
+
+
+@pytest.mark.parametrize(
+    ('p', 'expected'),
+    ((0, 1), (50, 5), (90, 9), (99, 10), (100, 10)),
+)
+def test_percentile(p, expected):
+    assert setup_cfg_fmt._percentile(list(range(1, 11)), p) == expected